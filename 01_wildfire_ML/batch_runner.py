@@ -0,0 +1,348 @@
+"""Batch runner of the wildfire hazard, risk and change assessment (ML approach)
+
+Run the Hazard, Risk and Change workflows for many combinations of future period, scenario and climate model
+at once: the static features are stored and the model is trained once on the historical climate, then the
+susceptibility, hazard, risk and change rasters of every combination are computed in a pool of processes.
+Combinations whose outputs are newer than their inputs are skipped, so an interrupted batch can simply be run
+again. The model is saved under a name made of a hash of the training inputs and parameters
+(see shared_funcs.training_key), so it is trained again when any of them changes.
+
+The inputs are the ones prepared by the Hazard and Risk notebooks (clipped DEM and derived layers, land cover,
+fires raster, resized climate rasters in climate/<config_id>/, clipped vulnerability rasters) in the folder
+data_<areaname>. The outputs are written with the same names used by the notebooks.
+
+Usage:
+python batch_runner.py scenarios.json --workers 8
+python batch_runner.py scenarios.json --instrument stages.json
+
+With --instrument, the wall time, CPU time, peak memory and bytes read and written of every stage of every
+process are logged to stages.jsonl and summarized in stages.json (see instrumentation.enable_instrumentation).
+
+Example of scenario matrix (all the combinations of scenarios, periods and climate models are run):
+{
+    "areaname": "Catalonia",
+    "hist_period": "199110",
+    "scenarios": ["RCP45", "RCP85"],
+    "periods": ["202140", "204160"],
+    "climate_models": ["CLMcom_CCLM", "CLMcom_RCA4"]
+}
+Single combinations can also be given with "combinations": [{"scenario": ..., "period": ..., "climate_model": ...}]
+
+A workflow from the CLIMAAX Handbook and FIRE GitHub repository.
+
+https://handbook.climaax.eu/
+https://github.com/CLIMAAX/FIRE
+"""
+
+import argparse
+import itertools
+import json
+import os
+import pathlib
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import pandas as pd
+import rasterio
+
+import instrumentation
+import shared_funcs
+
+
+DEFAULT_CONFIG = {
+    "areaname": "Catalonia",
+    "hist_period": "199110",
+    "var_names": [
+        "MWMT", "TD", "AHM", "SHM", "DDbelow0", "DDabove18", "MAT",
+        "MAP", "Tave_sm", "Tmax_sm", "PPT_at", "PPT_sm", "PPT_sp", "PPT_wt"
+    ],
+    # vulnerability rasters clipped by the Risk notebook, relative to data_<areaname>
+    "vulnerability": {
+        "population": "vulnerability/var-vuln-pop_unit-dimensionless.tiff",
+        "economical": "vulnerability/var-vuln-econ_unit-dimensionless.tiff",
+        "ecological": "vulnerability/var-vuln-ecol_unit-dimensionless.tiff"
+    },
+    "percentage": 0.1,
+    "max_depth": 10,
+    "number_of_trees": 100,
+    # seed of the sampling of the training pixels
+    "seed": 42,
+}
+# parameters of the training, part of the name of the saved model
+TRAINING_PARAMS = ["percentage", "max_depth", "number_of_trees", "seed"]
+
+# susceptibility classes x fuel types, see the Hazard notebook
+HAZARD_MATRIX = np.array([[1, 2, 3, 4],
+                          [2, 3, 4, 5],
+                          [3, 3, 5, 6]])
+
+# vulnerability classes x hazard classes, see the Risk notebook
+RISK_MATRIX = np.array([[1, 1, 1, 2, 3, 4],
+                        [1, 1, 2, 3, 4, 4],
+                        [1, 2, 3, 4, 4, 4]])
+
+
+def load_config(path):
+    """Read a scenario matrix (see the module docstring) and fill it with the defaults"""
+    with open(path, encoding='utf-8') as f:
+        config = {**DEFAULT_CONFIG, **json.load(f)}
+    combinations = list(config.get("combinations", []))
+    combinations += [
+        {"scenario": scenario, "period": period, "climate_model": climate_model}
+        for scenario, period, climate_model in itertools.product(
+            config.get("scenarios", []), config.get("periods", []), config.get("climate_models", [])
+        )
+    ]
+    config["combinations"] = combinations
+    return config
+
+
+def config_id(combination):
+    """Identifier of a combination used in the filenames, as in the notebooks"""
+    if combination.get("scenario") is None:
+        return f"HIST_{combination['period']}"
+    return f"{combination['scenario']}_{combination['climate_model']}_{combination['period']}"
+
+
+def area_paths(config):
+    """Paths of the inputs and outputs of the area, as in the notebooks"""
+    data_path_area = pathlib.Path(config.get("data_path_area", f"./data_{config['areaname']}"))
+    dem_path = data_path_area / "dem"
+    return {
+        "data_path_area": data_path_area,
+        # same order of the columns as in the Hazard notebook
+        "dem_paths": {"dem": dem_path / "dem_clip.tif"} | {
+            label: dem_path / f"{label}.tif" for label in ["slope", "aspect", "easting", "northing", "roughness"]
+        },
+        "clc_path_clip_nb": data_path_area / "land_cover" / "veg_corine_reclass_clip_nb.tif",
+        "fires_path_raster": data_path_area / "fires" / "fires_raster.tif",
+        "clim_path": data_path_area / "climate",
+        "features_path": data_path_area / "features",
+        "model_path": data_path_area / "models",
+        "suscep_path": data_path_area / "susceptibility",
+        "hazard_path": data_path_area / "hazard",
+        "risk_path": data_path_area / "risk",
+        "change_path": data_path_area / "change",
+    }
+
+
+def climate_files(config, combination):
+    """Paths of the resized climate rasters of a combination (see climate_paths in the Hazard notebook)"""
+    folder = area_paths(config)["clim_path"] / config_id(combination)
+    return {var_name: folder / f"{var_name}_{combination['period']}.tif" for var_name in config["var_names"]}
+
+
+def is_up_to_date(outputs, inputs):
+    """True if all the outputs exist and are newer than all the inputs"""
+    if not all(os.path.exists(path) for path in outputs):
+        return False
+    newest_input = max((os.path.getmtime(path) for path in inputs), default=0)
+    return min(os.path.getmtime(path) for path in outputs) >= newest_input
+
+
+def static_store_dir(config):
+    """Build (once) the store of the static features of the area, return its folder.
+
+    Called once before the pool of processes is created: the workers only open the store (see run_susceptibility).
+    """
+    paths = area_paths(config)
+    static_store = shared_funcs.static_feature_store(paths["features_path"] / "static", paths["dem_paths"],
+            paths["clc_path_clip_nb"])
+    return static_store["store_dir"]
+
+
+def train_model(config, static_dir, force=False):
+    """Train the model on the historical climate once and save it, return the path of the saved model"""
+    paths = area_paths(config)
+    hist = {"period": config["hist_period"]}
+    clim_files = climate_files(config, hist)
+    params = {name: config[name] for name in TRAINING_PARAMS}
+    # the name changes with the content of the inputs and with the parameters of the training
+    key = shared_funcs.training_key(paths["dem_paths"], paths["clc_path_clip_nb"], clim_files,
+            paths["fires_path_raster"], **params)
+    model_file = paths["model_path"] / f"model_{config_id(hist)}_{key}.npz"
+    if not force and model_file.exists():
+        print(f'Model {model_file} is up to date')
+        return model_file
+
+    feature_tiles = shared_funcs.FeatureTiles(paths["dem_paths"], paths["clc_path_clip_nb"], clim_files,
+            paths["fires_path_raster"], static_store=shared_funcs.open_feature_store(static_dir))
+    model, X_train, X_test, y_train, y_test = shared_funcs.prepare_sample_tiles(feature_tiles, **params)
+    shared_funcs.fit_and_print_stats(model, X_train, y_train, X_test, y_test, feature_tiles.columns)
+    paths["model_path"].mkdir(parents=True, exist_ok=True)
+    # the compiled forest is loaded by every process without unpickling the sklearn model
+    shared_funcs.compile_forest(model).save(model_file)
+    return model_file
+
+
+def run_susceptibility(config, combination, model_file, static_dir, force=False):
+    """Write the susceptibility raster of a combination, return its path"""
+    paths = area_paths(config)
+    output_file = paths["suscep_path"] / f"suscep_{config_id(combination)}.tif"
+    clim_files = climate_files(config, combination)
+    if not force and is_up_to_date([output_file], [model_file, *clim_files.values()]):
+        return output_file
+
+    # the static store is built by run_batch before the processes are started, here it is only opened
+    feature_tiles = shared_funcs.FeatureTiles(paths["dem_paths"], paths["clc_path_clip_nb"], clim_files,
+            static_store=shared_funcs.open_feature_store(static_dir))
+    paths["suscep_path"].mkdir(parents=True, exist_ok=True)
+    # one thread per process: the combinations already run in parallel
+    shared_funcs.predict_to_raster(shared_funcs.CompiledForest.load(model_file), feature_tiles, output_file,
+            n_workers=1, verbose=False)
+    return output_file
+
+
+def susceptibility_quantiles(suscep_file):
+    """Quantiles of the historical susceptibility used as bounds of the susceptibility classes"""
+    Y_raster = shared_funcs.read_raster(suscep_file, fill_value=-1)
+    return np.quantile(Y_raster[Y_raster >= 0.0], [0.5, 0.75])
+
+
+def fuel_types(config):
+    """Fuel types raster from the land cover, see the Hazard notebook"""
+    converter = pd.read_excel(pathlib.Path(__file__).parent / "CORINE_to_FuelType.xlsx")
+    converter_dict = dict(zip(converter.veg.values, converter.aggr.values))
+    my_clc_raster = shared_funcs.MyRaster(area_paths(config)["clc_path_clip_nb"], "clc")
+    return shared_funcs.corine_to_fuel_type(my_clc_raster.data.data, converter_dict)
+
+
+def categorize_with_thresholds(vul_arr):
+    """Categorizing based on thresholds >>> 0_30, 31_60, 61_100 (see the Risk notebook)"""
+    vul_arr_cat = np.full_like(vul_arr, fill_value=np.nan)
+    vul_arr_cat[vul_arr < 0.30] = 1
+    vul_arr_cat[(vul_arr >= 0.30) & (vul_arr <= 60)] = 2
+    vul_arr_cat[vul_arr > 0.60] = 3
+    return vul_arr_cat
+
+
+def run_hazard_and_risk(config, combination, suscep_file, quantiles, force=False):
+    """Write the hazard raster and the risk rasters of a combination, return their paths"""
+    paths = area_paths(config)
+    cid = config_id(combination)
+    hazard_file = paths["hazard_path"] / f"hazard_{cid}.tif"
+    hist_suscep_file = paths["suscep_path"] / f"suscep_{config_id({'period': config['hist_period']})}.tif"
+    # the quantiles come from the historical susceptibility
+    if force or not is_up_to_date([hazard_file], [suscep_file, hist_suscep_file, paths["clc_path_clip_nb"]]):
+        Y_raster = shared_funcs.read_raster(suscep_file, fill_value=-1)
+        hazard_arr = shared_funcs.classify_matrix(Y_raster, fuel_types(config), HAZARD_MATRIX, 0, -1,
+                x_bounds=quantiles)
+        paths["hazard_path"].mkdir(parents=True, exist_ok=True)
+        shared_funcs.write_raster(hazard_arr, hazard_file, paths["clc_path_clip_nb"], product="classes")
+
+    risk_files = {name: paths["risk_path"] / f"risk1_{name}_{cid}.tif" for name in config["vulnerability"]}
+    vul_files = {name: paths["data_path_area"] / path for name, path in config["vulnerability"].items()}
+    outdated = [name for name in risk_files
+                if force or not is_up_to_date([risk_files[name]], [hazard_file, vul_files[name]])]
+    if not outdated:
+        return hazard_file, risk_files
+
+    with rasterio.open(hazard_file) as src:
+        hazard_arr = src.read(1)
+    with rasterio.open(paths["dem_paths"]["dem"]) as src:
+        ref = src.read(1)
+    vul_arrs = []
+    for name in outdated:
+        with rasterio.open(vul_files[name]) as src:
+            vul_arr = src.read(1)
+        vul_arrs.append(categorize_with_thresholds(np.where(vul_arr > 0, vul_arr, np.nan)))
+    # all the outdated vulnerability layers against the same hazard in one sweep
+    risk_arrs = shared_funcs.classify_matrix(vul_arrs, hazard_arr, RISK_MATRIX, np.nan, 0)
+    paths["risk_path"].mkdir(parents=True, exist_ok=True)
+    for name, risk_arr in zip(outdated, risk_arrs):
+        shared_funcs.write_raster(np.where(ref == -9999, np.nan, risk_arr), risk_files[name],
+                paths["dem_paths"]["dem"], product="classes")
+    return hazard_file, risk_files
+
+
+def run_change(config, combination, force=False):
+    """Write the rasters of the change (future - historical) of susceptibility, hazard and risk"""
+    paths = area_paths(config)
+    hist_id, future_id = config_id({"period": config["hist_period"]}), config_id(combination)
+    layers = {
+        "suscep": paths["suscep_path"] / "suscep_{}.tif",
+        "hazard": paths["hazard_path"] / "hazard_{}.tif",
+        **{f"risk1_{name}": paths["risk_path"] / f"risk1_{name}_{{}}.tif" for name in config["vulnerability"]},
+    }
+    change_files = {}
+    for kind, template in layers.items():
+        hist_file, future_file = str(template).format(hist_id), str(template).format(future_id)
+        change_files[kind] = paths["change_path"] / f"change_{kind}_{hist_id}_{future_id}.tif"
+        if not force and is_up_to_date([change_files[kind]], [hist_file, future_file]):
+            continue
+        # the inputs are decoded (scaled probabilities) and their no data is NaN
+        diff = shared_funcs.read_raster(future_file) - shared_funcs.read_raster(hist_file)
+        paths["change_path"].mkdir(parents=True, exist_ok=True)
+        shared_funcs.write_raster(diff, change_files[kind], paths["dem_paths"]["dem"], product="continuous")
+    return change_files
+
+
+def run_batch(config, n_workers=None, force=False):
+    """Run all the combinations of a scenario matrix (see load_config) in a pool of processes.
+
+    :param config: scenario matrix
+    :param n_workers: Number of processes (number of CPUs by default)
+    :param force: If True, recompute the outputs even if they are up to date
+    :return: a dictionary with the outputs of every combination
+    """
+    static_dir = static_store_dir(config)
+    model_file = train_model(config, static_dir, force=force)
+    hist = {"period": config["hist_period"]}
+    combinations = config["combinations"]
+
+    with ProcessPoolExecutor(max_workers=n_workers) as executor:
+        # susceptibility of all the combinations
+        suscep_files = dict(zip(
+            [config_id(c) for c in [hist, *combinations]],
+            executor.map(run_susceptibility, *zip(*[
+                (config, c, model_file, static_dir, force) for c in [hist, *combinations]
+            ]))
+        ))
+        print('Susceptibility done')
+        # hazard and risk, with the classes of the historical susceptibility
+        quantiles = susceptibility_quantiles(suscep_files[config_id(hist)])
+        hazard_and_risk = dict(zip(
+            suscep_files,
+            executor.map(run_hazard_and_risk, *zip(*[
+                (config, c, suscep_files[config_id(c)], quantiles, force) for c in [hist, *combinations]
+            ]))
+        ))
+        print('Hazard and risk done')
+        # change with respect to the historical period
+        change = dict(zip(
+            [config_id(c) for c in combinations],
+            executor.map(run_change, *zip(*[(config, c, force) for c in combinations])) if combinations else []
+        ))
+        print('Change done')
+
+    return {
+        cid: {"susceptibility": suscep_files[cid], "hazard": hazard_and_risk[cid][0],
+              "risk": hazard_and_risk[cid][1], "change": change.get(cid, {})}
+        for cid in suscep_files
+    }
+
+
+def main():
+    """Run the batch from the command line"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('config', help='JSON file with the scenario matrix')
+    parser.add_argument('--workers', type=int, default=None, help='number of processes (number of CPUs by default)')
+    parser.add_argument('--force', action='store_true', help='recompute the outputs even if they are up to date')
+    parser.add_argument('--instrument', default=None, metavar='REPORT',
+            help='JSON report of the stages (the events of all the processes are logged to REPORT with .jsonl)')
+    args = parser.parse_args()
+
+    if args.instrument:
+        log_file = pathlib.Path(args.instrument).with_suffix(".jsonl")
+        log_file.unlink(missing_ok=True)
+        instrumentation.enable_instrumentation(log_file)
+    outputs = run_batch(load_config(args.config), n_workers=args.workers, force=args.force)
+    print(json.dumps(outputs, indent=2, default=str))
+    if args.instrument:
+        report = instrumentation.instrumentation_report(args.instrument, log_file=log_file)
+        for name, entry in report["summary"].items():
+            print(f'{name:20s} {entry["calls"]:5d} calls {entry["wall_s"]:10.2f} s')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,525 @@
+"""Benchmarks of the supporting functions for wildfire hazard assessment (ML approach)
+
+Compare the optimized functions of shared_funcs with the implementations they replace, on synthetic data,
+checking that the results are the same: vegetation_density against the convolution of every type (default)
+and, with --forest, CompiledForest.predict_proba against the predict_proba of the random forest.
+
+With --suite, run the hazard chains on synthetic, deterministic DEM, land cover, climate and fires GeoTIFFs
+of several sizes, with no downloaded data:
+- the in-memory chain of the Hazard notebooks (process_dem, assemble_veg_dictionary, preprocessing,
+  prepare_sample, fit, predict, susc_classes, corine_to_fuel_type, contigency_matrix_on_array)
+- the tiled chain of batch_runner (terrain_derivatives, static_feature_store, prepare_sample_tiles, fit,
+  predict_to_raster, hazard classes)
+The wall time, CPU time and peak of allocated memory (tracemalloc) of every stage and of the whole chain are
+saved to a JSON file, with the scaling against the raster size and against the number of workers, so the
+results of different commits can be compared (--compare). The synthetic rasters are written once to
+--data-dir and reused by later runs. The in-memory chain is skipped for the sizes which would not fit in
+--memory-limit.
+
+Usage:
+python benchmark_shared_funcs.py --size 4000 --types 15
+OMP_NUM_THREADS=1 python benchmark_shared_funcs.py --forest --rows 1000000 --trees 100 --max-depth 10
+python benchmark_shared_funcs.py --suite --sizes 1000 5000 20000 --workers 1 2 4 --output bench.json
+python benchmark_shared_funcs.py --suite --sizes 1000 5000 --output new.json --compare bench.json
+"""
+
+import argparse
+import contextlib
+import datetime
+import io
+import json
+import os
+import platform
+import subprocess
+import tempfile
+import time
+import tracemalloc
+import zlib
+
+import numpy as np
+import rasterio
+from sklearn.ensemble import RandomForestClassifier
+from rasterio.transform import from_origin
+from rasterio.windows import Window
+from scipy import signal
+
+import batch_runner
+import shared_funcs
+
+
+def timeit(func, *args, repeat=3, **kwargs):
+    """Best wall time of repeat calls of a function, and its result"""
+    best = np.inf
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(*args, **kwargs)
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+
+def synthetic_vegetation(size, n_types, seed=0):
+    """Vegetation raster with patches of n_types CORINE-like codes and 0 (non valid) pixels"""
+    rng = np.random.default_rng(seed)
+    codes = np.array([0, *range(311, 311 + n_types)])
+    # patches of 8x8 pixels, with some noise inside
+    coarse = rng.choice(codes, size=(size // 8 + 1, size // 8 + 1))
+    veg = np.kron(coarse, np.ones((8, 8), dtype=int))[:size, :size]
+    noise = rng.random((size, size)) < 0.1
+    veg[noise] = rng.choice(codes, size=noise.sum())
+    return veg, codes[1:]
+
+
+def legacy_vegetation_density(veg_int, types, window_size=2):
+    """Vegetation density layers as computed by assemble_veg_dictionary before vegetation_density"""
+    counter = np.ones((window_size*2+1, window_size*2+1))
+    counter = counter / np.sum(counter)
+    return np.stack([100 * signal.convolve2d(veg_int==t, counter, boundary='fill', mode='same') for t in types])
+
+
+def benchmark_vegetation_density(size, n_types, window_size, repeat):
+    """Compare vegetation_density with the convolution of every type"""
+    veg_int, types = synthetic_vegetation(size, n_types)
+    print(f'Vegetation density: {size}x{size} pixels, {n_types} types, window_size={window_size}')
+
+    t_legacy, legacy = timeit(legacy_vegetation_density, veg_int, types, window_size, repeat=repeat)
+    print(f'  convolve2d per type:           {t_legacy:8.3f} s')
+    t_serial, densities = timeit(shared_funcs.vegetation_density, veg_int, types, window_size, repeat=repeat)
+    print(f'  vegetation_density, 1 thread:  {t_serial:8.3f} s  (x{t_legacy / t_serial:.1f})')
+    t_parallel, _ = timeit(shared_funcs.vegetation_density, veg_int, types, window_size, n_workers=None,
+            repeat=repeat)
+    print(f'  vegetation_density, threads:   {t_parallel:8.3f} s  (x{t_legacy / t_parallel:.1f})')
+
+    identical = np.array_equal(densities, legacy.astype(np.float32))
+    densities64 = shared_funcs.vegetation_density(veg_int, types, window_size, dtype=np.float64)
+    print(f'  float32 results identical: {identical}, '
+          f'max difference in float64: {np.abs(legacy - densities64).max():.2e}')
+    print(f'  memory of the stack: {legacy.nbytes / 2**20:.0f} MiB (float64) -> {densities.nbytes / 2**20:.0f} MiB '
+          f'(float32), {densities.nbytes / 4 / 2**20:.0f} MiB as uint8 counts')
+    if not identical:
+        raise AssertionError('vegetation_density differs from the convolution')
+
+
+def synthetic_sample(n_rows, n_features=27, missing=0.01, seed=0):
+    """Features and labels of a synthetic fire dataset: continuous features (as the dem and climate layers),
+    integer features (as the vegetation densities, which give unbalanced trees) and some missing values"""
+    rng = np.random.default_rng(seed)
+    X = rng.normal(size=(n_rows, n_features)).astype(np.float32)
+    densities = slice(n_features // 3, 2 * n_features // 3)
+    X[:, densities] = np.clip(np.round(50 + 40 * X[:, densities]), 0, 100)
+    Y = ((X[:, 0] + 0.5 * X[:, 1] * X[:, 2] > 0.5) & (X[:, densities.start] > 40)
+         | (rng.random(n_rows) < 0.05)).astype(np.int8)
+    X[rng.random(X.shape) < missing] = np.nan
+    return X, Y
+
+
+def benchmark_forest(n_rows, number_of_trees, max_depth, repeat):
+    """Compare CompiledForest.predict_proba with the predict_proba of the random forest (on one core, set
+    OMP_NUM_THREADS=1 so that sklearn does not use more)"""
+    X_train, Y_train = synthetic_sample(50000, seed=1)
+    model = RandomForestClassifier(n_estimators=number_of_trees, max_depth=max_depth, n_jobs=1, random_state=0)
+    model.fit(X_train, Y_train)
+    forest = shared_funcs.compile_forest(model)
+    X, _ = synthetic_sample(n_rows)
+    forest.predict_proba(X[:1])  # compile the kernel (or load it from the cache) before timing
+    print(f'Random forest inference: {n_rows} rows, {X.shape[1]} features, {number_of_trees} trees, '
+          f'max_depth={max_depth}, {len(forest.child)} nodes')
+
+    t_sklearn, expected = timeit(model.predict_proba, X, repeat=repeat)
+    print(f'  RandomForestClassifier, n_jobs=1:   {t_sklearn:8.3f} s')
+    t_serial, proba = timeit(forest.predict_proba, X, repeat=repeat)
+    print(f'  CompiledForest, 1 thread:           {t_serial:8.3f} s  (x{t_sklearn / t_serial:.2f})')
+    t_parallel, _ = timeit(forest.predict_proba, X, n_workers=None, repeat=repeat)
+    print(f'  {f"CompiledForest, {os.cpu_count()} threads:":36}{t_parallel:8.3f} s  (x{t_sklearn / t_parallel:.2f})')
+
+    identical = np.array_equal(proba, expected)
+    print(f'  results identical: {identical}')
+    if not identical:
+        raise AssertionError('CompiledForest.predict_proba differs from the random forest')
+
+
+DEM_NODATA = -9999
+CLIMATE_LABELS = batch_runner.DEFAULT_CONFIG["var_names"]
+SYNTHETIC_BLOCK = 512
+
+
+def synthetic_window(kind, window, size, n_types, seed=0):
+    """Content of a window of a synthetic raster, which only depends on the window (and seed), not on the order
+    in which the windows are written.
+
+    The region is a disc inscribed in the raster (DEM nodata and land cover 0 outside), the DEM and the
+    climate layers are smooth fields with some noise, the land cover is made of patches of 16x16 pixels of
+    n_types CORINE-like codes (311, 312, ...) and the fires are clusters covering a few percent of the region.
+    """
+    rng = np.random.default_rng([seed, zlib.crc32(kind.encode()), window.row_off, window.col_off])
+    rows, cols = np.mgrid[window.row_off:window.row_off + window.height, window.col_off:window.col_off + window.width]
+    outside = (rows - size / 2)**2 + (cols - size / 2)**2 > (0.48 * size)**2
+    if kind == "dem":
+        dem = (800 + 500 * np.sin(rows / 211) * np.cos(cols / 173) + 150 * np.sin((rows + 2 * cols) / 57)
+               + rng.normal(0, 2, rows.shape))
+        return np.where(outside, DEM_NODATA, dem).astype(np.float32)
+    if kind == "veg":
+        codes = np.array([0, *range(311, 311 + n_types)])
+        # the windows are multiples of 16 pixels (but the last ones), so the patches never cross windows
+        coarse = rng.choice(codes, size=(window.height // 16 + 1, window.width // 16 + 1))
+        veg = np.kron(coarse, np.ones((16, 16), dtype=np.int16))[:window.height, :window.width]
+        return np.where(outside, 0, veg).astype(np.int16)
+    if kind == "fires":
+        fires = np.sin(rows / 37) * np.sin(cols / 41) + 0.3 * rng.random(rows.shape) > 1.0
+        return np.where(outside, 0, fires).astype(np.uint8)
+    i = CLIMATE_LABELS.index(kind)
+    climate = (10 * i + 5 * np.sin(rows / (300 + 50 * i) + i) * np.cos(cols / (250 + 40 * i))
+               + rng.normal(0, 0.1, rows.shape))
+    return climate.astype(np.float32)
+
+
+def write_synthetic_rasters(folder, size, n_types=12, n_climate=4, seed=0):
+    """Write (once) the synthetic GeoTIFFs of a size, window by window, and return their paths.
+
+    :param folder: Path to the folder of the synthetic data, the rasters go to the subfolder of the size
+    :param size: side of the rasters in pixels
+    :param n_types: number of vegetation types
+    :param n_climate: number of climate layers (named as in batch_runner.DEFAULT_CONFIG)
+    :param seed: seed of the noise
+    :return: dictionary with the paths of the "dem", "veg" and "fires" rasters and the "climate" paths by label
+    """
+    folder = os.path.join(folder, f"synthetic_{size}_{n_types}_{n_climate}_{seed}")
+    paths = {"dem": os.path.join(folder, "dem.tif"), "veg": os.path.join(folder, "veg.tif"),
+             "fires": os.path.join(folder, "fires.tif"),
+             "climate": {label: os.path.join(folder, f"{label}.tif") for label in CLIMATE_LABELS[:n_climate]}}
+    # written last, so that an interrupted run is never taken for a complete set of rasters
+    done_file = os.path.join(folder, "done")
+    if os.path.exists(done_file):
+        return paths
+
+    os.makedirs(folder, exist_ok=True)
+    profile = dict(driver="GTiff", width=size, height=size, count=1, crs="EPSG:3035",
+                   transform=from_origin(3_500_000, 2_500_000, 100, 100), tiled=True,
+                   blockxsize=SYNTHETIC_BLOCK, blockysize=SYNTHETIC_BLOCK, compress="deflate", BIGTIFF="IF_SAFER")
+    rasters = {
+        "dem": (paths["dem"], "float32", DEM_NODATA),
+        "veg": (paths["veg"], "int16", None),
+        "fires": (paths["fires"], "uint8", None),
+        **{label: (path, "float32", None) for label, path in paths["climate"].items()},
+    }
+    windows = [Window(col, row, min(SYNTHETIC_BLOCK, size - col), min(SYNTHETIC_BLOCK, size - row))
+               for row in range(0, size, SYNTHETIC_BLOCK) for col in range(0, size, SYNTHETIC_BLOCK)]
+    for kind, (path, dtype, nodata) in rasters.items():
+        with rasterio.open(path, "w", dtype=dtype, nodata=nodata, **profile) as dst:
+            for window in windows:
+                dst.write(synthetic_window(kind, window, size, n_types, seed), 1, window=window)
+    with open(done_file, "w", encoding="utf-8"):
+        pass
+    return paths
+
+
+def fuel_converter(n_types):
+    """Fuel types (1 to 4) of the synthetic vegetation codes, in place of CORINE_to_FuelType.xlsx"""
+    return {code: 1 + i % 4 for i, code in enumerate(range(311, 311 + n_types))}
+
+
+class Stages:
+    """Run the stages of a pipeline and record their wall time, CPU time and peak of allocated memory.
+
+    The memory is the peak allocated during the stage on top of what was allocated before it, as traced by
+    tracemalloc (numpy arrays included), so it is only recorded when tracemalloc is running. The peak of all
+    the stages (allocations held across the stages included) is kept in peak.
+    The output of the stages is discarded: the notebooks functions print their progress.
+    """
+    def __init__(self):
+        self.records = {}
+        self.peak = 0
+
+    def __call__(self, name, func, *args, **kwargs):
+        tracing = tracemalloc.is_tracing()
+        if tracing:
+            tracemalloc.reset_peak()
+            before = tracemalloc.get_traced_memory()[0]
+        start, cpu_start = time.perf_counter(), time.process_time()
+        with contextlib.redirect_stdout(io.StringIO()):
+            result = func(*args, **kwargs)
+        record = {"wall_s": time.perf_counter() - start, "cpu_s": time.process_time() - cpu_start}
+        if tracing:
+            peak = tracemalloc.get_traced_memory()[1]
+            record["peak_mib"] = (peak - before) / 2**20
+            self.peak = max(self.peak, peak)
+        self.records[name] = record
+        return result
+
+
+def memory_chain(stage, paths, work_dir, n_types, n_workers, number_of_trees, max_depth):
+    """Hazard chain of the Hazard notebooks, with all the rasters in memory (see make_model and get_results)"""
+    terrain = stage("process_dem", shared_funcs.process_dem, paths["dem"], os.path.join(work_dir, "dem"))
+    dem_dict = stage("assemble_dem_dict", shared_funcs.assemble_dem_dict, [paths["dem"], *terrain.values()],
+            ["dem", *terrain])
+    veg_dict, mask = stage("assemble_veg_dictionary", shared_funcs.assemble_veg_dictionary, paths["veg"],
+            paths["dem"])
+    climate_dict = stage("read_climate", lambda: {
+        label: shared_funcs.MyRaster(path, label) for label, path in paths["climate"].items()})
+    fires_raster = stage("read_fires", shared_funcs.MyRaster, paths["fires"], "fires")
+    X_all, Y_all, _ = stage("preprocessing", shared_funcs.preprocessing, dem_dict, veg_dict, climate_dict,
+            fires_raster, mask, verbose=False)
+    model, X_train, _, y_train, _ = stage("prepare_sample", shared_funcs.prepare_sample, X_all, Y_all,
+            max_depth=max_depth, number_of_trees=number_of_trees, seed=0)
+    model.set_params(verbose=0, n_jobs=n_workers or -1)
+    stage("fit", model.fit, X_train, y_train)
+    forest = stage("compile_forest", shared_funcs.compile_forest, model)
+    proba = stage("predict_proba", forest.predict_proba, X_all, n_workers=n_workers)
+
+    # susceptibility map and classes as in the Hazard notebook
+    Y_raster = np.full(mask.shape, -1, dtype=np.float32)
+    Y_raster[mask] = proba[:, 1]
+    quantiles = np.quantile(proba[:, 1], [0.5, 0.75])
+    susc_arr = stage("susc_classes", shared_funcs.susc_classes, Y_raster, quantiles) + 1
+    converted_band = stage("corine_to_fuel_type", shared_funcs.corine_to_fuel_type,
+            veg_dict["veg"].data.data, fuel_converter(n_types))
+    stage("contigency_matrix_on_array", shared_funcs.contigency_matrix_on_array, susc_arr, converted_band,
+            batch_runner.HAZARD_MATRIX, 0, -1)
+
+
+def tiled_chain(stage, paths, work_dir, n_types, n_workers, number_of_trees, max_depth):
+    """Hazard chain of batch_runner, reading the rasters window by window (see train_model and run_hazard_and_risk)"""
+    terrain_paths = {label: os.path.join(work_dir, f"{label}.tif") for label in shared_funcs.TERRAIN_LAYERS}
+    dem_paths = {"dem": paths["dem"], **stage("terrain_derivatives", shared_funcs.terrain_derivatives,
+            paths["dem"], terrain_paths, n_workers=n_workers)}
+    static_store = stage("static_feature_store", shared_funcs.static_feature_store,
+            os.path.join(work_dir, "static"), dem_paths, paths["veg"], verbose=False)
+    feature_tiles = shared_funcs.FeatureTiles(dem_paths, paths["veg"], paths["climate"], paths["fires"],
+            static_store=static_store)
+    model, X_train, _, y_train, _ = stage("prepare_sample_tiles", shared_funcs.prepare_sample_tiles,
+            feature_tiles, max_depth=max_depth, number_of_trees=number_of_trees, seed=0, n_workers=n_workers)
+    model.set_params(verbose=0, n_jobs=n_workers or -1)
+    stage("fit", model.fit, X_train, y_train)
+    forest = stage("compile_forest", shared_funcs.compile_forest, model)
+    suscep_file = os.path.join(work_dir, "suscep.tif")
+    stage("predict_to_raster", shared_funcs.predict_to_raster, forest,
+            shared_funcs.FeatureTiles(dem_paths, paths["veg"], paths["climate"], static_store=static_store),
+            suscep_file, n_workers=n_workers, verbose=False)
+
+    def hazard():
+        Y_raster = shared_funcs.read_raster(suscep_file, fill_value=-1)
+        quantiles = np.quantile(Y_raster[Y_raster >= 0.0], [0.5, 0.75])
+        converted_band = shared_funcs.corine_to_fuel_type(shared_funcs.MyRaster(paths["veg"], "veg").data.data,
+                fuel_converter(n_types))
+        hazard_arr = shared_funcs.classify_matrix(Y_raster, converted_band, batch_runner.HAZARD_MATRIX, 0, -1,
+                x_bounds=quantiles)
+        shared_funcs.write_raster(hazard_arr, os.path.join(work_dir, "hazard.tif"), paths["veg"],
+                product="classes")
+    stage("hazard", hazard)
+
+
+CHAINS = {"memory": memory_chain, "tiled": tiled_chain}
+
+
+def memory_chain_bytes(size, n_types, n_climate):
+    """Rough estimate of the memory used by the in-memory chain: the rasters of all the features (as masked
+    arrays) and the X_all matrix, both float32"""
+    n_features = 1 + len(shared_funcs.TERRAIN_LAYERS) + 1 + n_types + n_climate
+    return size * size * n_features * (4 + 1 + 4)
+
+
+def run_chain(chain, paths, data_dir, repeat, trace_memory, **kwargs):
+    """Run a chain repeat times (plus once with tracemalloc, if trace_memory) in fresh working folders.
+
+    :return: the best wall time of every stage (with its CPU time and peak of memory) and of the whole chain
+    """
+    runs = []
+    for traced in [False] * repeat + [True] * trace_memory:
+        stages = Stages()
+        with tempfile.TemporaryDirectory(dir=data_dir) as work_dir:
+            if traced:
+                tracemalloc.start()
+            start, cpu_start = time.perf_counter(), time.process_time()
+            CHAINS[chain](stages, paths, work_dir, **kwargs)
+            total = {"wall_s": time.perf_counter() - start, "cpu_s": time.process_time() - cpu_start}
+            if traced:
+                total["peak_mib"] = max(stages.peak, tracemalloc.get_traced_memory()[1]) / 2**20
+                tracemalloc.stop()
+        runs.append((traced, stages.records, total))
+
+    timed = [(records, total) for traced, records, total in runs if not traced or repeat == 0]
+    best = {name: min((records[name] for records, _ in timed), key=lambda r: r["wall_s"]) for name in timed[0][0]}
+    best_total = min((total for _, total in timed), key=lambda r: r["wall_s"])
+    for traced, records, total in runs:
+        if traced:
+            for name, record in records.items():
+                best[name] = {**best[name], "peak_mib": record["peak_mib"]}
+            best_total = {**best_total, "peak_mib": total["peak_mib"]}
+    return best, best_total
+
+
+def worker_scaling(paths, work_dir, n_types, workers, repeat, memory_limit, number_of_trees, max_depth):
+    """Wall time of the parallel stages (terrain_derivatives, vegetation_density, predict_to_raster) against the
+    number of workers, with the speedup with respect to the first number of workers"""
+    terrain_paths = {label: os.path.join(work_dir, f"{label}.tif") for label in shared_funcs.TERRAIN_LAYERS}
+    dem_paths = {"dem": paths["dem"], **terrain_paths}
+    with contextlib.redirect_stdout(io.StringIO()):
+        shared_funcs.terrain_derivatives(paths["dem"], terrain_paths)
+        feature_tiles = shared_funcs.FeatureTiles(dem_paths, paths["veg"], paths["climate"], paths["fires"])
+        model, X_train, _, y_train, _ = shared_funcs.prepare_sample_tiles(feature_tiles, max_depth=max_depth,
+                number_of_trees=number_of_trees, seed=0)
+        model.set_params(verbose=0, n_jobs=-1)
+        forest = shared_funcs.compile_forest(model.fit(X_train, y_train))
+    feature_tiles = shared_funcs.FeatureTiles(dem_paths, paths["veg"], paths["climate"])
+
+    stages = {
+        "terrain_derivatives": lambda w: shared_funcs.terrain_derivatives(paths["dem"], terrain_paths, n_workers=w),
+        "predict_to_raster": lambda w: shared_funcs.predict_to_raster(forest, feature_tiles,
+                os.path.join(work_dir, "suscep.tif"), n_workers=w, verbose=False),
+    }
+    size = feature_tiles.shape[0]
+    # the stack of the densities (float32) and the types (int)
+    if size * size * (4 * n_types + 8) <= memory_limit:
+        veg_int = shared_funcs.MyRaster(paths["veg"], "veg").data.filled(0).astype(int)
+        types = np.arange(311, 311 + n_types)
+        stages["vegetation_density"] = lambda w: shared_funcs.vegetation_density(veg_int, types, n_workers=w)
+
+    scaling = {}
+    for name, stage in stages.items():
+        wall = [timeit(stage, w, repeat=repeat)[0] for w in workers]
+        scaling[name] = {"workers": list(workers), "wall_s": wall, "speedup": [wall[0] / t for t in wall]}
+        print(f'  {name:22s}' + ''.join(f'  {w} workers: {t:8.3f} s' for w, t in zip(workers, wall)))
+    return scaling
+
+
+def size_exponent(pixels, wall):
+    """Exponent of the power law wall ~ pixels**exponent fitted to the timings (1 is linear scaling)"""
+    if len(pixels) < 2:
+        return None
+    return float(np.polyfit(np.log(pixels), np.log(wall), 1)[0])
+
+
+def git_commit():
+    """Commit of the working tree, None if not in a git repository"""
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def compare_results(results, baseline):
+    """Print the ratio of the wall times of every stage with respect to a previous run"""
+    print(f'Comparison with {baseline["meta"]["commit"]} (new / baseline wall time)')
+    previous = {(run["chain"], run["size"]): run for run in baseline["runs"] if "stages" in run}
+    for run in results["runs"]:
+        old = previous.get((run["chain"], run["size"]))
+        if "stages" not in run or old is None:
+            continue
+        print(f'  {run["chain"]} chain, {run["size"]}x{run["size"]} pixels')
+        for name, record in [*run["stages"].items(), ("total", run["total"])]:
+            if name in old["stages"] or name == "total":
+                old_wall = (old["total"] if name == "total" else old["stages"][name])["wall_s"]
+                print(f'    {name:28s} {record["wall_s"]:8.3f} s / {old_wall:8.3f} s = '
+                      f'{record["wall_s"] / old_wall:5.2f}')
+
+
+def benchmark_suite(args):
+    """Run the hazard chains on the synthetic rasters of all the sizes, save and return the results"""
+    data_dir = args.data_dir
+    os.makedirs(data_dir, exist_ok=True)
+    chain_kwargs = dict(n_types=args.types, n_workers=args.chain_workers, number_of_trees=args.trees,
+                        max_depth=args.max_depth)
+    results = {
+        "meta": {
+            "commit": git_commit(),
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+            "python": platform.python_version(),
+            "numpy": np.__version__,
+            "platform": platform.platform(),
+            "cpu_count": os.cpu_count(),
+            "args": vars(args),
+        },
+        "runs": [],
+        "size_scaling": {},
+        "worker_scaling": {},
+    }
+    for size in args.sizes:
+        start = time.perf_counter()
+        paths = write_synthetic_rasters(data_dir, size, args.types, args.climate)
+        print(f'Synthetic rasters {size}x{size} pixels ready in {time.perf_counter() - start:.1f} s')
+        for chain in args.chains:
+            run = {"chain": chain, "size": size, "pixels": size * size}
+            estimate = memory_chain_bytes(size, args.types, args.climate)
+            if chain == "memory" and estimate > args.memory_limit * 2**30:
+                run["skipped"] = f'estimated memory {estimate / 2**30:.1f} GiB > {args.memory_limit:.1f} GiB'
+                print(f'  {chain} chain skipped: {run["skipped"]}')
+            else:
+                run["stages"], run["total"] = run_chain(chain, paths, data_dir, args.repeat, not args.no_memory,
+                        **chain_kwargs)
+                print(f'  {chain} chain:')
+                for name, record in [*run["stages"].items(), ("total", run["total"])]:
+                    memory = f'{record["peak_mib"]:9.1f} MiB' if "peak_mib" in record else ''
+                    print(f'    {name:28s} {record["wall_s"]:8.3f} s  cpu {record["cpu_s"]:8.3f} s {memory}')
+            results["runs"].append(run)
+
+    for chain in args.chains:
+        runs = [run for run in results["runs"] if run["chain"] == chain and "stages" in run]
+        if not runs:
+            continue
+        pixels = [run["pixels"] for run in runs]
+        results["size_scaling"][chain] = {}
+        for name in [*runs[0]["stages"], "total"]:
+            wall = [(run["total"] if name == "total" else run["stages"][name])["wall_s"] for run in runs]
+            results["size_scaling"][chain][name] = {"pixels": pixels, "wall_s": wall,
+                                                    "exponent": size_exponent(pixels, wall)}
+
+    if args.workers:
+        scaling_size = args.scaling_size or max(args.sizes)
+        print(f'Scaling with the number of workers, {scaling_size}x{scaling_size} pixels')
+        paths = write_synthetic_rasters(data_dir, scaling_size, args.types, args.climate)
+        with tempfile.TemporaryDirectory(dir=data_dir) as work_dir:
+            results["worker_scaling"] = worker_scaling(paths, work_dir, args.types, args.workers, args.repeat,
+                    args.memory_limit * 2**30, args.trees, args.max_depth)
+        results["worker_scaling"]["size"] = scaling_size
+
+    with open(args.output, "w", encoding="utf-8") as f:
+        json.dump(results, f, indent=2)
+    print(f'Results saved to {args.output}')
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            compare_results(results, json.load(f))
+    return results
+
+
+def main():
+    """Run the benchmarks"""
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--size', type=int, default=2000, help='side of the synthetic rasters in pixels')
+    parser.add_argument('--types', type=int, default=12, help='number of vegetation types')
+    parser.add_argument('--window-size', type=int, default=2, help='half size of the vegetation density window')
+    parser.add_argument('--repeat', type=int, default=3, help='number of runs of every function (best is kept)')
+    parser.add_argument('--forest', action='store_true',
+            help='benchmark the inference of the random forest (with --rows, --trees, --max-depth)')
+    parser.add_argument('--rows', type=int, default=1_000_000, help='number of rows evaluated by the forest')
+    suite = parser.add_argument_group('suite of the hazard chains (--suite)')
+    suite.add_argument('--suite', action='store_true', help='run the hazard chains on synthetic rasters')
+    suite.add_argument('--sizes', type=int, nargs='+', default=[1000, 5000], help='sides of the rasters in pixels')
+    suite.add_argument('--chains', nargs='+', choices=list(CHAINS), default=list(CHAINS), help='chains to run')
+    suite.add_argument('--climate', type=int, default=4, help='number of climate layers')
+    suite.add_argument('--trees', type=int, default=20, help='number of trees of the random forest')
+    suite.add_argument('--max-depth', type=int, default=8, help='maximum depth of the trees')
+    suite.add_argument('--chain-workers', type=int, default=None,
+            help='number of workers of the chains (number of CPUs by default)')
+    suite.add_argument('--workers', type=int, nargs='*', default=[1, 2, 4],
+            help='numbers of workers of the scaling of the parallel stages (none to skip it)')
+    suite.add_argument('--scaling-size', type=int, default=None,
+            help='side of the rasters of the worker scaling (largest of --sizes by default)')
+    suite.add_argument('--memory-limit', type=float,
+            default=0.8 * os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') / 2**30,
+            help='memory available to the in-memory chain in GiB (80%% of the physical memory by default)')
+    suite.add_argument('--no-memory', action='store_true', help='do not trace the memory (one run less)')
+    suite.add_argument('--data-dir', default='benchmark_data', help='folder of the synthetic rasters')
+    suite.add_argument('--output', default='benchmark_results.json', help='JSON file of the results')
+    suite.add_argument('--compare', default=None, help='JSON file of a previous run to compare with')
+    args = parser.parse_args()
+
+    if args.suite:
+        benchmark_suite(args)
+    elif args.forest:
+        benchmark_forest(args.rows, args.trees, args.max_depth, args.repeat)
+    else:
+        benchmark_vegetation_density(args.size, args.types, args.window_size, args.repeat)
+
+
+if __name__ == '__main__':
+    main()
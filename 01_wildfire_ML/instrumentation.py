@@ -0,0 +1,242 @@
+"""Instrumentation of the stages of the wildfire hazard assessment pipeline (ML approach)
+
+Record the wall time, CPU time, peak memory and bytes read and written of the stages of the pipeline (the
+functions of shared_funcs decorated with instrumented and the blocks run in `with stage(name):`), as events
+appended to a JSON lines file (or kept in memory, up to MAX_EVENTS) and summarized by instrumentation_report.
+The progress messages of shared_funcs are printed with log, which can silence them.
+
+Usage:
+import instrumentation
+instrumentation.enable_instrumentation("stages.jsonl")
+... run the workflow ...
+instrumentation.instrumentation_report("stages.json")
+
+A workflow from the CLIMAAX Handbook and FIRE GitHub repository.
+
+https://handbook.climaax.eu/
+https://github.com/CLIMAAX/FIRE
+"""
+
+import collections
+import contextlib
+import functools
+import json
+import os
+import threading
+import time
+import tracemalloc
+
+
+# number of events kept in memory when there is no log file, the oldest ones are dropped
+MAX_EVENTS = 100_000
+# State of the instrumentation of the pipeline stages, see enable_instrumentation
+INSTRUMENTATION = {"enabled": False, "trace_memory": False, "log_file": None, "messages": True,
+                   "events": collections.deque(maxlen=MAX_EVENTS)}
+# environment variable passing the log file to the worker processes (e.g. of batch_runner)
+INSTRUMENTATION_ENV = "FIRE_INSTRUMENTATION_LOG"
+_open_stages = []
+
+
+def enable_instrumentation(log_file=None, trace_memory=False, messages=True):
+    """Record the wall time, CPU time, peak memory and bytes read and written of every stage of the pipeline.
+
+    The stages are the functions decorated with instrumented (DEM processing, reprojection, vegetation density,
+    feature assembly, sampling, fit, inference, classification and raster writing) and the blocks run in
+    `with stage(name):`. The values of a stage include its nested stages. Every stage gives an event (a dictionary,
+    see stage) which is appended to log_file as a line of JSON as soon as the stage ends, or without log_file kept
+    in INSTRUMENTATION["events"] (the last MAX_EVENTS events), see instrumentation_report. The log file is also
+    used by the worker processes started afterwards, which get it from the environment.
+    When the instrumentation is disabled (default) a stage costs a dictionary lookup.
+
+    The peak memory is the peak resident set size of the process during the stage and the bytes are the ones
+    read and written by the process (page cache included), both from /proc (Linux only, None elsewhere).
+    With trace_memory, the peak of the memory allocated by Python and numpy (tracemalloc) is recorded too,
+    which slows down the code allocating many small objects.
+
+    :param log_file: Path of a JSON lines file where the events are appended, None to keep them in memory
+    :param trace_memory: If True, trace the allocations with tracemalloc
+    :param messages: If False, the progress messages of the functions (see log) are not printed
+
+    usage example:
+    enable_instrumentation("stages.jsonl")
+    ... run the workflow ...
+    instrumentation_report("stages.json")
+    """
+    INSTRUMENTATION.update(enabled=True, trace_memory=trace_memory, log_file=log_file, messages=messages)
+    if log_file is not None:
+        os.environ[INSTRUMENTATION_ENV] = os.path.abspath(log_file)
+    if trace_memory and not tracemalloc.is_tracing():
+        tracemalloc.start()
+
+
+def disable_instrumentation():
+    """Stop recording the stages (the recorded events are kept, and the log file is still read by
+    instrumentation_report)"""
+    INSTRUMENTATION.update(enabled=False)
+    os.environ.pop(INSTRUMENTATION_ENV, None)
+    if INSTRUMENTATION["trace_memory"] and tracemalloc.is_tracing():
+        tracemalloc.stop()
+
+
+def _read_proc(name):
+    """Lines of a file of /proc/self split in key and value, None if not available"""
+    try:
+        with open(f"/proc/self/{name}", encoding="ascii") as f:
+            return dict(line.split(":", 1) for line in f if ":" in line)
+    except OSError:
+        return None
+
+
+def _peak_rss():
+    """Peak resident set size of the process since the last _reset_peaks, in bytes"""
+    status = _read_proc("status")
+    return None if status is None else int(status["VmHWM"].split()[0]) * 1024
+
+
+def _reset_peaks():
+    """Reset the peak resident set size (Linux 4.0+) and the peak of tracemalloc"""
+    try:
+        with open("/proc/self/clear_refs", "w", encoding="ascii") as f:
+            f.write("5")
+    except OSError:
+        pass
+    if tracemalloc.is_tracing():
+        tracemalloc.reset_peak()
+
+
+def _update_peaks(state):
+    """Update the peaks of an open stage with the current peaks of the process"""
+    rss = _peak_rss()
+    if rss is not None:
+        state["peak_rss"] = max(state["peak_rss"] or 0, rss)
+    if tracemalloc.is_tracing():
+        state["peak_alloc"] = max(state["peak_alloc"] or 0, tracemalloc.get_traced_memory()[1])
+
+
+def _emit(event):
+    """Append an event to the log file, or keep it in memory if there is no log file"""
+    if INSTRUMENTATION["log_file"] is None:
+        INSTRUMENTATION["events"].append(event)
+        return
+    # a single write of a line, so the events of several processes are not mixed
+    with open(INSTRUMENTATION["log_file"], "a", encoding="utf-8") as f:
+        f.write(json.dumps(event, default=str) + "\n")
+
+
+@contextlib.contextmanager
+def stage(name, **info):
+    """Run a block of code as a stage of the pipeline, see enable_instrumentation.
+
+    The event of the stage has the keys: event ("stage"), stage (name), parent (name of the enclosing stage),
+    pid, start (seconds since the epoch), wall_s, cpu_s (all the threads of the process), peak_rss_mib,
+    peak_alloc_mib (with trace_memory), read_mib, written_mib and the keyword arguments info.
+    Only the stages of the main thread are recorded, and a stage nested in a stage of the same name is merged
+    with it (e.g. sample_pixels called by prepare_sample_tiles).
+
+    usage example:
+    with stage("fit", rows=len(X_train)):
+        model.fit(X_train, y_train)
+    """
+    if (not INSTRUMENTATION["enabled"] or threading.current_thread() is not threading.main_thread()
+            or any(open_stage["name"] == name for open_stage in _open_stages)):
+        yield
+        return
+
+    parent = _open_stages[-1] if _open_stages else None
+    if parent is not None:
+        # the peaks are reset for this stage, keep the ones reached so far by the parent
+        _update_peaks(parent)
+    _reset_peaks()
+    state = {"name": name, "peak_rss": None, "peak_alloc": None}
+    io_start = _read_proc("io")
+    start, wall_start, cpu_start = time.time(), time.perf_counter(), time.process_time()
+    _open_stages.append(state)
+    try:
+        yield
+    finally:
+        _open_stages.pop()
+        wall, cpu = time.perf_counter() - wall_start, time.process_time() - cpu_start
+        _update_peaks(state)
+        if parent is not None:
+            for key in ("peak_rss", "peak_alloc"):
+                if state[key] is not None:
+                    parent[key] = max(parent[key] or 0, state[key])
+        io_end = _read_proc("io")
+        io = {key: None if io_start is None else (int(io_end[key]) - int(io_start[key])) / 2**20
+              for key in ("rchar", "wchar")}
+        _emit({
+            "event": "stage",
+            "stage": name,
+            "parent": None if parent is None else parent["name"],
+            "pid": os.getpid(),
+            "start": start,
+            "wall_s": wall,
+            "cpu_s": cpu,
+            "peak_rss_mib": None if state["peak_rss"] is None else state["peak_rss"] / 2**20,
+            "peak_alloc_mib": None if state["peak_alloc"] is None else state["peak_alloc"] / 2**20,
+            "read_mib": io["rchar"],
+            "written_mib": io["wchar"],
+            **info,
+        })
+
+
+def instrumented(name):
+    """Decorator running every call of a function as a stage (see stage), with the name of the function"""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            if not INSTRUMENTATION["enabled"]:
+                return func(*args, **kwargs)
+            with stage(name, function=func.__qualname__):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def log(message):
+    """Print a progress message (unless INSTRUMENTATION["messages"] is False) and record it as an event"""
+    if INSTRUMENTATION["messages"]:
+        print(message)
+    if INSTRUMENTATION["enabled"]:
+        _emit({"event": "message", "stage": _open_stages[-1]["name"] if _open_stages else None, "pid": os.getpid(),
+               "time": time.time(), "message": str(message)})
+
+
+def instrumentation_report(output_file=None, log_file=None):
+    """Summary of the recorded stages, for every stage name: number of calls, total wall and CPU time, maximum of
+    the peak memory and total MiB read and written (the nested stages are included in their parents).
+
+    :param output_file: Path of a JSON file where the report is saved, if given
+    :param log_file: Path of a log file of enable_instrumentation to take the events from (e.g. with the events of
+        the worker processes). By default, the log file given to enable_instrumentation, or the events kept in
+        memory if there was none.
+    :return: dictionary with the "summary" by stage name and all the "events"
+    """
+    events = list(INSTRUMENTATION["events"])
+    log_file = INSTRUMENTATION["log_file"] if log_file is None else log_file
+    if log_file is not None:
+        with open(log_file, encoding="utf-8") as f:
+            events = [json.loads(line) for line in f]
+    summary = {}
+    for event in events:
+        if event["event"] != "stage":
+            continue
+        entry = summary.setdefault(event["stage"], {"calls": 0, "wall_s": 0.0, "cpu_s": 0.0, "peak_rss_mib": None,
+                                                    "peak_alloc_mib": None, "read_mib": None, "written_mib": None})
+        entry["calls"] += 1
+        entry["wall_s"] += event["wall_s"]
+        entry["cpu_s"] += event["cpu_s"]
+        for key, combine in [("peak_rss_mib", max), ("peak_alloc_mib", max), ("read_mib", sum),
+                             ("written_mib", sum)]:
+            if event[key] is not None:
+                entry[key] = event[key] if entry[key] is None else combine([entry[key], event[key]])
+    report = {"summary": summary, "events": events}
+    if output_file is not None:
+        with open(output_file, "w", encoding="utf-8") as f:
+            json.dump(report, f, indent=2, default=str)
+    return report
+
+
+if os.environ.get(INSTRUMENTATION_ENV):
+    # worker process of an instrumented run
+    enable_instrumentation(os.environ[INSTRUMENTATION_ENV])
@@ -11,22 +11,35 @@ Contributors:
 - Giorgio Meschi (Giorgio.meschi@cimafoundation.org)
 """
 
+import contextlib
+import functools
+import hashlib
+import json
 import os
+import shutil
+import tempfile
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, as_completed, wait
 
 from tqdm import tqdm
+import numba
 import numpy as np
-from osgeo import gdal
+import pandas as pd
 import rasterio
+import rasterio.shutil
 from rasterio import features
 from rasterio.plot import show
-from scipy import signal
+from rasterio.warp import Resampling, reproject, transform_bounds
+from rasterio.windows import Window, from_bounds, transform as window_transform
 import sklearn
-from sklearn.model_selection import train_test_split
+from sklearn.model_selection import ParameterGrid, train_test_split
 from sklearn.ensemble import RandomForestClassifier
 import matplotlib.pyplot as plt
 import matplotlib.colors as mcolors
 
+from instrumentation import instrumented, log, stage
 
+
+@instrumented("raster_write")
 def save_raster_as(array, output_file, reference_file, **kwargs):
     """Save a raster from a 2D numpy array using another raster as reference to get the spatial extent and projection.
     
@@ -54,6 +67,7 @@ def plot_raster_V2(raster, ref_arr, cmap='seismic', title='', figsize=(10, 8), d
     classes_names = [ 'no data', 'Very Low', 'Low', 'Medium', 'High', 'Extreme'], # names
 
     add_to_ax: pass an axs to overlay other object to the same ax. it is a tuple (fig, ax)
+    raster and ref_arr can also be paths: they are then read at the resolution of the figure (see read_raster)
     '''
     if plot_kwargs is None:
         plot_kwargs = {}
@@ -64,6 +78,16 @@ def plot_raster_V2(raster, ref_arr, cmap='seismic', title='', figsize=(10, 8), d
         fig = add_to_ax[0]
         ax = add_to_ax[1]
 
+    # rasters given as paths are read at the resolution of the axes (from their overviews if they have them)
+    # and arrays larger than the axes are decimated: drawing more pixels than the figure has is wasted
+    axes_shape = axes_pixels(ax)
+    if isinstance(raster, (str, os.PathLike)):
+        raster = read_raster(raster, max_shape=axes_shape)
+    if isinstance(ref_arr, (str, os.PathLike)):
+        ref_arr = read_raster(ref_arr, out_shape=np.shape(raster), fill_value=-9999)
+    step = max(1, min(np.shape(raster)[0] // axes_shape[0], np.shape(raster)[1] // axes_shape[1]))
+    raster, ref_arr = raster[::step, ::step], ref_arr[::step, ::step]
+
     if len(array_classes) > 0 and len(classes_colors) > 0 and len(classes_names) > 0:
         cmap = mcolors.ListedColormap(classes_colors)
         norm = mcolors.BoundaryNorm(array_classes, cmap.N)
@@ -114,6 +138,7 @@ def plot_raster_V2(raster, ref_arr, cmap='seismic', title='', figsize=(10, 8), d
     return fig, ax
 
 
+@instrumented("raster_write")
 def save_raster_as_h(array, output_file, reference_file, **kwargs):
     """Save a raster from a 2D numpy array using another raster as reference to get the spatial extent and projection.
     
@@ -131,63 +156,480 @@ def save_raster_as_h(array, output_file, reference_file, **kwargs):
             dst.write(array.astype(profile['dtype']), 1)
 
 
+# Encoding of the output rasters: the smallest dtype for every kind of product
+RASTER_PRODUCTS = {
+    # hazard, risk and other classes, 0 is no data (as in classify_matrix)
+    "classes": {"dtype": "int8", "nodata": 0, "scale": 1.0, "resampling": "nearest"},
+    # probabilities from 0 to 1 in steps of 1/250, for maps only: the susceptibility is classified from its
+    # quantiles, which would move with the steps, so it is kept continuous (see predict_to_raster)
+    "probability": {"dtype": "uint8", "nodata": 255, "scale": 1 / 250, "resampling": "average"},
+    # any other value (e.g. susceptibility, changes of susceptibility)
+    "continuous": {"dtype": "float32", "nodata": np.nan, "scale": 1.0, "resampling": "average"},
+}
+
+
+def encode_product(array, product):
+    """Values of array in the dtype of a product of RASTER_PRODUCTS.
+
+    The masked values, NaN and (for probabilities) the negative values are set to the nodata value of the product.
+
+    :param array: array with the values (can be a masked array)
+    :param product: name of the product in RASTER_PRODUCTS
+    :return: array with the encoded values
+    """
+    spec = RASTER_PRODUCTS[product]
+    dtype = np.dtype(spec["dtype"])
+    data = np.ma.getdata(array)
+    invalid = np.ma.getmaskarray(array)
+    if np.issubdtype(data.dtype, np.floating):
+        invalid = invalid | np.isnan(data)
+        if product == "probability":
+            invalid |= data < 0
+        if dtype.kind in "iu":
+            info = np.iinfo(dtype)
+            data = np.clip(np.rint(np.where(invalid, 0, data) / spec["scale"]), info.min, info.max)
+    encoded = data.astype(dtype)
+    encoded[invalid] = spec["nodata"]
+    return encoded
+
+
+def overview_factors(shape, min_size=256):
+    """Decimation factors of the overviews of a raster, down to an overview of about min_size pixels"""
+    factors = []
+    factor = 2
+    while max(shape) // factor >= min_size:
+        factors.append(factor)
+        factor *= 2
+    return factors
+
+
+class RasterWriter:
+    """Write a product (see RASTER_PRODUCTS) window by window to a compressed, tiled, cloud-optimized GeoTIFF.
+
+    The windows are written to a temporary tiled GeoTIFF. When the writer is closed, the internal overviews are
+    built and the file is copied to output_file with the COG driver (the overviews are kept), so that maps can be
+    drawn from the overviews (see read_raster).
+
+    usage example:
+    with RasterWriter(output_file, dem_path, product="probability") as writer:
+        for window in raster_windows(dem_path):
+            writer.write(probability_in(window), window)
+    """
+    def __init__(self, output_file, reference_file, product="continuous", block_size=512, compress="deflate",
+            overviews=True, **kwargs):
+        """
+        :param output_file: Path to the output raster
+        :param reference_file: Path to a raster who's geotransform and projection will be used
+        :param product: name of the product in RASTER_PRODUCTS (dtype, nodata and scale of the output)
+        :param block_size: size of the tiles in pixels (multiple of 16)
+        :param compress: compression of the output raster
+        :param overviews: If True, build the internal overviews
+        :param kwargs: Keyword arguments to update the profile of the output raster
+        """
+        spec = RASTER_PRODUCTS[product]
+        with rasterio.open(reference_file) as src:
+            profile = src.profile
+        profile.update(driver='GTiff', dtype=spec["dtype"], nodata=spec["nodata"], count=1, tiled=True,
+                blockxsize=block_size, blockysize=block_size, compress=compress,
+                predictor=2 if np.dtype(spec["dtype"]).kind in "iu" else 3, BIGTIFF='IF_SAFER')
+        profile.update(**kwargs)
+        self.output_file = output_file
+        self.product = product
+        self.profile = profile
+        self.overviews = overviews
+        self.tmp_file = f"{output_file}.tmp.tif"
+        self.dst = rasterio.open(self.tmp_file, 'w', **profile)
+        self.dst.scales = (spec["scale"],)
+        self.dst.update_tags(product=product)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.dst.close()
+            os.remove(self.tmp_file)
+
+    def write(self, array, window=None):
+        """Encode array and write it in window (the full raster by default)"""
+        self.dst.write(encode_product(array, self.product), 1, window=window)
+
+    @instrumented("raster_write")
+    def close(self):
+        """Build the overviews and write the output raster"""
+        self.dst.close()
+        if self.overviews:
+            with rasterio.open(self.tmp_file, 'r+') as dst:
+                dst.build_overviews(overview_factors(dst.shape),
+                        Resampling[RASTER_PRODUCTS[self.product]["resampling"]])
+        rasterio.shutil.copy(self.tmp_file, self.output_file, driver='COG', blocksize=self.profile['blockxsize'],
+                compress=self.profile['compress'], predictor='YES', overviews='FORCE_USE_EXISTING',
+                BIGTIFF=self.profile['BIGTIFF'])
+        os.remove(self.tmp_file)
+
+
+@instrumented("raster_write")
+def write_raster(array, output_file, reference_file, product="continuous", block_size=512, **kwargs):
+    """Save a 2D array as a product (see RASTER_PRODUCTS and RasterWriter), block by block.
+
+    :param array: 2D numpy array with the data
+    :param output_file: Path to the output raster
+    :param reference_file: Path to a raster who's geotransform and projection will be used
+    :param product: name of the product in RASTER_PRODUCTS
+    :param block_size: size of the tiles and of the blocks encoded at once
+    :param kwargs: Keyword arguments of RasterWriter
+
+    usage example:
+    write_raster(hazard_arr, hazard_path_hist, clc_path_clip_nb, product="classes")
+    """
+    with RasterWriter(output_file, reference_file, product, block_size, **kwargs) as writer:
+        for window in raster_windows(reference_file, block_size):
+            writer.write(array[window.toslices()], window)
+
+
+def axes_pixels(ax):
+    """Size (rows, columns) in pixels of a matplotlib axes"""
+    bbox = ax.get_window_extent()
+    return max(1, int(bbox.height)), max(1, int(bbox.width))
+
+
+def read_raster(path, max_shape=None, out_shape=None, fill_value=np.nan):
+    """Read the first band of a raster as float32, with the scale and offset applied (see RASTER_PRODUCTS).
+
+    With max_shape (e.g. the size of a figure in pixels, see axes_pixels), the raster is read at the coarsest
+    overview that still has at least max_shape pixels, so that drawing a map does not read the full resolution.
+    Rasters without overviews are decimated to the same size.
+
+    :param path: Path to the raster
+    :param max_shape: (rows, columns) of the target, None to read the full resolution
+    :param out_shape: (rows, columns) of the output, overrides max_shape (e.g. to match another raster)
+    :param fill_value: value of the nodata pixels
+    :return: 2D array
+    """
+    with rasterio.open(path) as src:
+        if out_shape is None and max_shape is not None:
+            factor = max(1, min(src.height // max_shape[0], src.width // max_shape[1]))
+            overviews = [f for f in src.overviews(1) if f <= factor]
+            if overviews:
+                factor = max(overviews)
+            out_shape = (-(-src.height // factor), -(-src.width // factor))
+        data = src.read(1, out_shape=out_shape, masked=True, resampling=Resampling.nearest)
+        scale, offset = src.scales[0], src.offsets[0]
+    data = data.astype(np.float32)
+    if (scale, offset) != (1, 0):
+        data = data * np.float32(scale) + np.float32(offset)
+    return data.filled(fill_value)
+
+
+def read_change_pair(path_hist, path_future, mask_path, max_shape=None):
+    """Read a historical and a future raster at the same resolution, to map their difference.
+
+    :param path_hist: Path to the historical raster, read with read_raster(path_hist, max_shape)
+    :param path_future: Path to the future raster, read at the resolution of the historical one
+    :param mask_path: Path to a raster (e.g. the DEM) whose no data pixels are masked, read at the same resolution
+    :param max_shape: (rows, columns) of the map, None to read the full resolution
+    :return: hist, future (2D float32 arrays with NaN for no data) and the mask (True where mask_path has no data)
+
+    usage example:
+    suscep_hist, suscep_future, mask = read_change_pair(suscep_path_hist, suscep_path_future, dem_path, (1500, 1500))
+    """
+    hist = read_raster(path_hist, max_shape=max_shape)
+    future = read_raster(path_future, out_shape=hist.shape)
+    mask = np.isnan(read_raster(mask_path, out_shape=hist.shape))
+    return hist, future, mask
+
+
+TERRAIN_LAYERS = ["slope", "aspect", "northing", "easting", "roughness"]
+
+
+def terrain_window(dem, res_x, res_y, nodata=None):
+    """Compute the terrain derivatives of a window of a DEM read with a halo of 1 pixel.
+
+    Slope (degrees) and aspect (degrees, azimuth from north) use the 3x3 Horn kernel and roughness is the
+    difference between the max and the min of the 3x3 window, as gdal.DEMProcessing does. Northing and
+    easting are the cosine and sine of the aspect.
+    The pixels whose 3x3 window contains nodata or falls outside of the DEM, and the aspect (and so
+    northing and easting) of flat pixels, are set to -9999.
+
+    :param dem: 2D array of the window extended by 1 pixel on each side, with nodata (or NaN) outside the DEM
+    :param res_x: pixel size along x
+    :param res_y: pixel size along y
+    :param nodata: nodata value of the DEM
+    :return: a dictionary with the float32 arrays of the TERRAIN_LAYERS, of the size of the window
+    """
+    dem = dem.astype(np.float64)
+    if nodata is not None:
+        dem[dem == nodata] = np.nan
+    height, width = dem.shape[0] - 2, dem.shape[1] - 2
+    # the 3x3 neighbours of every pixel:
+    # a b c
+    # d e f
+    # g h i
+    a, b, c, d, _, f, g, h, i = [dem[r:r + height, col:col + width] for r in range(3) for col in range(3)]
+
+    dx = (c + 2*f + i) - (a + 2*d + g)
+    dy = (g + 2*h + i) - (a + 2*b + c)
+    slope = np.degrees(np.arctan(np.hypot(dx / (8 * res_x), dy / (8 * res_y))))
+    aspect = np.degrees(np.arctan2(dy, -dx))
+    aspect = np.where(aspect > 90.0, 450.0 - aspect, 90.0 - aspect)
+    aspect[aspect == 360.0] = 0.0
+    flat = (dx == 0) & (dy == 0)
+    aspect[flat] = np.nan
+    northing = np.cos(np.radians(aspect))
+    easting = np.sin(np.radians(aspect))
+    neighbours = [a, b, c, d, dem[1:-1, 1:-1], f, g, h, i]
+    roughness = np.maximum.reduce(neighbours) - np.minimum.reduce(neighbours)
+
+    layers = {"slope": slope, "aspect": aspect, "northing": northing, "easting": easting, "roughness": roughness}
+    return {label: np.nan_to_num(layers[label], nan=-9999).astype(np.float32) for label in TERRAIN_LAYERS}
+
+
+@instrumented("dem_processing")
+def terrain_derivatives(dem_path, output_paths=None, block_size=512, n_workers=None, verbose=False):
+    """Compute slope, aspect, northing, easting and roughness of a DEM in a single tiled pass.
+
+    Every window of the DEM is read once with a halo of 1 pixel and all the derivatives are computed from it
+    (see terrain_window). The results are written to the output rasters window by window, or kept in memory
+    if no output_paths are given: the arrays can be passed to FeatureTiles in place of the paths.
+
+    :param dem_path: Path to the DEM
+    :param output_paths: dictionary with the paths of the outputs, with keys in TERRAIN_LAYERS (all of them are
+        computed, only the given ones are written). If None, the derivatives are returned in memory.
+    :param block_size: size of the windows in pixels
+    :param n_workers: Number of threads (number of CPUs by default)
+    :param verbose: If True, show the progress
+    :return: output_paths, or a dictionary with the 2D float32 arrays of the derivatives
+
+    usage example:
+    terrain = terrain_derivatives(dem_path)
+    dem_paths = {"dem": dem_path, **terrain}
+    """
+    with rasterio.open(dem_path) as src:
+        profile = src.profile
+        nodata = src.nodata
+        res_x, res_y = src.res
+    profile.update(dtype='float32', nodata=-9999, count=1)
+
+    fill_value = np.nan if nodata is None else nodata
+    def compute(window):
+        return terrain_window(read_window(dem_path, window, halo=1, fill_value=fill_value), res_x, res_y, nodata)
+
+    windows = raster_windows(dem_path, block_size)
+    if output_paths is None:
+        results = {label: np.empty((profile['height'], profile['width']), dtype=np.float32)
+                   for label in TERRAIN_LAYERS}
+        for window, layers in tqdm(map_windows(compute, windows, n_workers), total=len(windows),
+                desc="terrain derivatives", disable=not verbose):
+            for label, layer in layers.items():
+                results[label][window.toslices()] = layer
+        return results
+
+    with contextlib.ExitStack() as stack:
+        outputs = {label: stack.enter_context(rasterio.open(path, 'w', **profile))
+                   for label, path in output_paths.items()}
+        for window, layers in tqdm(map_windows(compute, windows, n_workers), total=len(windows),
+                desc="terrain derivatives", disable=not verbose):
+            for label, dst in outputs.items():
+                dst.write(layers[label], 1, window=window)
+    return output_paths
+
+
 def process_dem(dem_path, output_folder, verbose=False):
-    """Calculate slope and aspect from a DEM and save them to the output folder.
+    """Calculate slope, aspect, northing, easting and roughness from a DEM and save them to the output folder.
     
     :param dem_path: Path to the DEM
     :param output_folder: Path to the output folder
     :param verbose: If True, print some messages
-    :return: Nothing
+    :return: a dictionary with the paths of the outputs
     """
-    slope_path = os.path.join(output_folder, "slope.tif")
-    aspect_path = os.path.join(output_folder, "aspect.tif")
-    northing_path = os.path.join(output_folder, "northing.tif")
-    easting_path = os.path.join(output_folder, "easting.tif")
-    roughness_path = os.path.join(output_folder, "roughness.tif")
+    output_paths = {label: os.path.join(output_folder, f"{label}.tif") for label in TERRAIN_LAYERS}
     # Create the output folder if it doesn't exist
     os.makedirs(output_folder, exist_ok=True)
 
-    with rasterio.open(dem_path) as src:
-        if verbose:
-            print(f'Reading dem file {dem_path}')
-        dem = src.read(1, masked  = True)
-        if verbose:
-            print(f'This is what {dem_path} looks like')
-            plt.imshow(dem)
-            plt.title('DEM')
-            plt.colorbar(shrink = 0.5)
-            plt.xticks([])
-            plt.yticks([])
-            plt.show()
-            print('Calculating slope, aspect and roughness')
-            gdal.DEMProcessing(slope_path, dem_path, 'slope')
-            gdal.DEMProcessing(aspect_path, dem_path, 'aspect')
-            gdal.DEMProcessing(roughness_path, dem_path, 'roughness')
-
-    with rasterio.open(aspect_path) as f:
-        if verbose:
-            print('Calculating northing and easting files')
-            print(f'Reading aspect file {aspect_path}')
-        aspect = f.read(1,   masked = True)
+    if verbose:
+        with rasterio.open(dem_path) as src:
+            log(f'Reading dem file {dem_path}')
+            dem = src.read(1, masked  = True)
+        log(f'This is what {dem_path} looks like')
+        plt.imshow(dem)
+        plt.title('DEM')
+        plt.colorbar(shrink = 0.5)
+        plt.xticks([])
+        plt.yticks([])
+        plt.show()
+        del dem
+        log('Calculating slope, aspect, northing, easting and roughness')
+
+    terrain_derivatives(dem_path, output_paths, verbose=verbose)
+
+    if verbose:
+        with rasterio.open(output_paths["aspect"]) as f:
+            aspect = f.read(1, masked = True)
+        log('Aspect looks like this...')
+        plt.imshow(aspect)
+        plt.title('Aspect')
+        plt.colorbar(shrink = 0.5)
+        plt.xticks([])
+        plt.yticks([])
+        plt.show()
+    return output_paths
+
+
+REPROJECT_MANIFEST = "reproject_manifest.json"
+# memory of the source and destination arrays of the rasters warped together by reproject_rasters
+REPROJECT_BATCH_BYTES = 2**28
+
+
+def _source_window(src, bounds, pad):
+    """Window of src covering bounds (in the crs of src), with pad more pixels on every side"""
+    window = from_bounds(*bounds, transform=src.transform)
+    col_start = max(int(np.floor(window.col_off)) - pad, 0)
+    row_start = max(int(np.floor(window.row_off)) - pad, 0)
+    col_stop = min(int(np.ceil(window.col_off + window.width)) + pad, src.width)
+    row_stop = min(int(np.ceil(window.row_off + window.height)) + pad, src.height)
+    if col_stop <= col_start or row_stop <= row_start:
+        raise ValueError(f"{src.name} does not overlap the reference raster")
+    return Window(col_start, row_start, col_stop - col_start, row_stop - row_start)
+
+
+def _write_band(band, output_path, profile):
+    """Write a single band raster, return its shape"""
+    with rasterio.open(output_path, 'w', **profile) as dst:
+        dst.write(band, 1)
+        return list(dst.shape)
+
+
+def _load_manifest(manifest_file):
+    """Entries of the manifest of reproject_rasters, by output file name"""
+    if not os.path.exists(manifest_file):
+        return {}
+    with open(manifest_file, encoding='utf-8') as f:
+        return json.load(f)
+
+
+def _save_manifest(manifest_file, manifest):
+    """Replace the manifest of reproject_rasters, so an interrupted run keeps the outputs already done"""
+    with open(f"{manifest_file}.tmp", 'w', encoding='utf-8') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(f"{manifest_file}.tmp", manifest_file)
+
+
+def _outdated_groups(raster_list, output_paths, checksums, manifest, grid):
+    """Rasters whose output is missing or out of date (see reproject_rasters), grouped by source grid"""
+    groups = {}
+    for path, output_path, checksum in zip(raster_list, output_paths, checksums):
+        entry = manifest.get(os.path.basename(output_path), {})
+        if os.path.exists(output_path) and entry.get("source") == checksum and entry.get("grid") == grid:
+            continue
+        with rasterio.open(path) as src:
+            key = (src.crs.to_wkt(), tuple(src.transform)[:6], src.shape, src.dtypes[0], repr(src.nodata))
+        groups.setdefault(key, []).append((path, output_path, checksum))
+    return groups
+
+
+def _warp_bands(source, dst_shape, dtype, src_nodata, dst_nodata, resampling, warp_kwargs):
+    """Warp a stack of bands of the same grid at once, with the no data of a single band warp"""
+    destination = np.full((len(source), *dst_shape), 0 if dst_nodata is None else dst_nodata, dtype=dtype)
+    # every band has its own no data mask, as when the rasters are warped one by one
+    reproject(source, destination, src_nodata=src_nodata, dst_nodata=dst_nodata,
+            resampling=getattr(Resampling, resampling), UNIFIED_SRC_NODATA="NO", **warp_kwargs)
+    if src_nodata is not None and resampling != "nearest":
+        # a single band warp also gives no data where the source pixel under the target pixel is no data
+        invalid = np.isnan(source) if np.isnan(src_nodata) else source == src_nodata
+        invalid_dst = np.zeros(destination.shape, dtype=np.uint8)
+        reproject(invalid.view(np.uint8), invalid_dst, resampling=Resampling.nearest, **warp_kwargs)
+        destination[invalid_dst == 1] = dst_nodata
+    return destination
+
+
+@instrumented("reprojection")
+def reproject_rasters(raster_list, output_folder, reference_file, resampling="bilinear", n_workers=None,
+        verbose=True):
+    """Reproject rasters to match the resolution, projection and region of a reference raster.
+
+    The rasters are grouped by source grid (projection, transform, shape, dtype and nodata). Only the part of
+    every source covering the reference is read, and the rasters of a group are warped together as the bands
+    of one array, by batches of at most REPROJECT_BATCH_BYTES of source and destination arrays: the source
+    window and the warp parameters are computed once per pair of grids, and the memory does not grow with the
+    number of rasters. Reading, warping and writing use n_workers threads. The outputs are tiled GeoTIFFs with
+    the file names of the sources, like those of reproject_match_reference in the Hazard notebook.
+    The checksum of the source and the target grid of every output are recorded in a manifest in
+    output_folder: the outputs whose source and target grid did not change are not computed again.
+    The shapes of the outputs are checked against the reference from the manifest, without opening them.
+
+    :param raster_list: list of paths of the rasters to reproject
+    :param output_folder: Path to the folder of the outputs
+    :param reference_file: Path to the reference raster (e.g. the clipped DEM)
+    :param resampling: name of the resampling method (see rasterio.enums.Resampling)
+    :param n_workers: Number of threads (number of CPUs by default)
+    :param verbose: If True, print the outputs that are computed and the result of the check of the shapes
+    :return: list of the paths of the outputs, in the order of raster_list
+
+    usage example:
+    clim_files_hist = reproject_rasters(eclips_files_hist, clim_path_hist, dem_path_clip, n_workers=4)
+    """
+    n_workers = n_workers or os.cpu_count()
+    os.makedirs(output_folder, exist_ok=True)
+    with rasterio.open(reference_file) as ref:
+        dst_crs, dst_transform, dst_bounds = ref.crs, ref.transform, ref.bounds
+        dst_shape = ref.shape
+    grid = hashlib.sha256(json.dumps(
+        [dst_crs.to_wkt(), list(dst_transform)[:6], list(dst_shape), resampling]).encode()).hexdigest()
+    profile = {
+        "driver": "GTiff", "count": 1, "crs": dst_crs, "transform": dst_transform, "height": dst_shape[0],
+        "width": dst_shape[1], "compress": "lzw", "tiled": True, "blockxsize": 512, "blockysize": 512,
+        "BIGTIFF": "YES",
+    }
+
+    manifest_file = os.path.join(output_folder, REPROJECT_MANIFEST)
+    manifest = _load_manifest(manifest_file)
+    output_paths = [os.path.join(output_folder, os.path.basename(path)) for path in raster_list]
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        checksums = list(executor.map(file_checksum, raster_list))
+    groups = _outdated_groups(raster_list, output_paths, checksums, manifest, grid)
+
+    for (_, _, _, dtype, _), group in groups.items():
+        with rasterio.open(group[0][0]) as src:
+            src_crs, src_nodata = src.crs, src.nodata
+            # a few more pixels than the kernel of the resampling when going to a coarser resolution
+            ratio = max(abs(dst_transform.a / src.transform.a), abs(dst_transform.e / src.transform.e))
+            pad = 2 + int(np.ceil(ratio))
+            window = _source_window(src, transform_bounds(dst_crs, src_crs, *dst_bounds, densify_pts=21), pad)
+            src_transform = window_transform(window, src.transform)
+        dst_nodata = src_nodata
+        if dst_nodata is None and np.issubdtype(np.dtype(dtype), np.floating):
+            dst_nodata = np.nan
+        warp_kwargs = {"src_transform": src_transform, "src_crs": src_crs, "dst_transform": dst_transform,
+                       "dst_crs": dst_crs, "num_threads": n_workers}
+        band_bytes = (window.height * window.width + dst_shape[0] * dst_shape[1]) * np.dtype(dtype).itemsize
+        batch_size = max(1, REPROJECT_BATCH_BYTES // band_bytes)
+
+        for start in range(0, len(group), batch_size):
+            batch = group[start:start + batch_size]
+            if verbose:
+                log(f"Reprojecting {', '.join(os.path.basename(path) for path, _, _ in batch)}")
+            with ThreadPoolExecutor(max_workers=n_workers) as executor:
+                read = functools.partial(read_window, window=window)
+                source = np.stack(list(executor.map(read, [path for path, _, _ in batch])))
+                destination = _warp_bands(source, dst_shape, dtype, src_nodata, dst_nodata, resampling, warp_kwargs)
+                del source
+                write = functools.partial(_write_band, profile={**profile, "dtype": dtype, "nodata": dst_nodata})
+                shapes = list(executor.map(write, destination, [output_path for _, output_path, _ in batch]))
+            for (_, output_path, checksum), shape in zip(batch, shapes):
+                manifest[os.path.basename(output_path)] = {"source": checksum, "grid": grid, "shape": shape}
+            _save_manifest(manifest_file, manifest)
+
+    for output_path in output_paths:
+        name = os.path.basename(output_path)
+        same = manifest[name]["shape"] == list(dst_shape)
         if verbose:
-            print('Aspect looks like this...')
-            plt.imshow(aspect)
-            plt.title('Aspect')
-            plt.colorbar(shrink = 0.5)
-            plt.xticks([])
-            plt.yticks([])
-            plt.show()
-        #aspect[aspect <= -9999] = np.NaN
-    northing = np.cos(aspect * np.pi/180.0)
-    print(f'Saving northing file {northing_path}')
-    save_raster_as(northing, northing_path, aspect_path)
-    del northing
-    print(f'Saving easting file {easting_path}')
-    easting = np.sin(aspect * np.pi/180.0)
-    save_raster_as(easting, easting_path, aspect_path)
-    del easting
+            log(f"{name} {'has' if same else 'does NOT have'} the same dimensions as the reference raster.")
+    return output_paths
 
 
+@instrumented("rasterize")
 def rasterize_numerical_feature(gdf, reference_file, column=None, verbose=True):
     """Rasterize a vector file using a reference raster to get the shape and the transform.
     
@@ -197,53 +639,50 @@ def rasterize_numerical_feature(gdf, reference_file, column=None, verbose=True):
     :return: Rasterized version of the vector file
     """
     with rasterio.open(reference_file) as f:
-        out = f.read(1,   masked = True)
-        myshape = out.shape
-        mytransform = f.transform #f. ...
-    del out
+        myshape = f.shape
+        mytransform = f.transform
     if verbose:
-        print("Shape of the reference raster:", myshape)
-        print("Transform of the reference raster:", mytransform)
+        log(f"Shape of the reference raster: {myshape}")
+        log(f"Transform of the reference raster: {mytransform}")
     out_array = np.zeros(myshape)#   out.shape)
     # this is where we create a generator of geom, value pairs to use in rasterizing
     if column is not None:
         shapes = ((geom, value) for geom, value in zip(gdf.geometry, gdf[column]))
     else:
         shapes = ((geom, 1) for geom in gdf.geometry)
-    print("Features.rasterize is launched...")
     burned = features.rasterize(shapes=shapes, fill=np.NaN, out=out_array, transform=mytransform)#, all_touched=True)
     #    out.write_band(1, burned)
-    print("Features.rasterize is done...")
     return burned
 
 
 class MyRaster:
-    """Handle the path and metadata of a raster
+    """Handle the path and metadata of a raster. The raster is read when the object is created, unless read=False.
     
     dem_raster = MyRaster(dem_path, "dem")
-    dem_raster.read_raster()
     slope_raster = MyRaster(slope_path, "slope")
-    slope_raster.read_raster()
     northing_raster = MyRaster(aspect_path, "aspect")
-    northing_raster.read_raster()
     easting_raster = MyRaster(easting_path, "easting")
-    easting_raster.read_raster()
     roughness_raster = MyRaster(roughness_path, "roughness")
     dem_rasters = [dem_raster, slope_raster, northing_raster, easting_raster, roughness_raster]
     """
-    def __init__(self, path, label):
+    def __init__(self, path, label, read=True):
         self.path = path
         self.label = label
         self.data = None
         self.mask = None
         self.nodata = None
-        self.read_raster()
+        if read:
+            self.read_raster()
 
     def read_raster(self):
         with rasterio.open(self.path) as src:
             self.data = src.read(1, masked=True)
             self.mask = src.read_masks(1)
             self.nodata = src.nodata
+            scale, offset = src.scales[0], src.offsets[0]
+        # products stored as scaled integers (see RASTER_PRODUCTS) are decoded
+        if (scale, offset) != (1, 0):
+            self.data = self.data.astype(np.float32) * np.float32(scale) + np.float32(offset)
 
     def set_data(self, data):
         self.data = data
@@ -282,11 +721,73 @@ def assemble_dem_dict(dem_paths, dem_labels):
     dem_dict = {}
     for path, label in zip(dem_paths, dem_labels):
         dem_dict[label] = MyRaster(path, label)
-        dem_dict[label].read_raster()
 
     return dem_dict
 
 
+def box_count(mask, window_size=2):
+    """Count the True pixels in the (2*window_size+1) x (2*window_size+1) box around every pixel.
+
+    Pixels outside the array count as False. The box sums are computed with running sums along the rows and
+    then along the columns, so the cost does not depend on window_size.
+
+    :param mask: 2D boolean array
+    :param window_size: half size of the box
+    :return: array with the counts, uint8 if they fit (window_size <= 7), else uint16
+    """
+    size = 2*window_size + 1
+    dtype = np.uint8 if size*size <= np.iinfo(np.uint8).max else np.uint16
+    # the running sums overflow, but their differences are exact in modular arithmetic as long as the counts fit
+    padded = np.pad(mask, window_size).astype(dtype)
+    csum = np.cumsum(padded, axis=0, dtype=dtype)
+    rows = csum[size - 1:].copy()
+    rows[1:] -= csum[:-size]
+    csum = np.cumsum(rows, axis=1, dtype=dtype)
+    counts = csum[:, size - 1:].copy()
+    counts[:, 1:] -= csum[:, :-size]
+    return counts
+
+
+def vegetation_density(veg_int, types, window_size=2, dtype=np.float32, n_workers=1):
+    """Compute the vegetation density layers (perc_* layers) of all the vegetation types at once.
+
+    The density of a type is the percentage of pixels of that type in the (2*window_size+1) x (2*window_size+1)
+    window around every pixel, as 100 * signal.convolve2d(veg_int==t, counter, boundary='fill', mode='same')
+    with the normalized box kernel counter. The neighbour counts are computed with box_count and converted
+    to percentages with a lookup table of the correctly rounded values 100 * count / (2*window_size+1)**2.
+    The float32 result is bit-identical to the convolution cast to float32 (the dtype of the feature matrices),
+    the float64 one differs from the convolution only by its rounding errors (~1e-14).
+
+    :param veg_int: 2D integer array with the vegetation types (0 for the non valid pixels)
+    :param types: vegetation types
+    :param window_size: half size of the window
+    :param dtype: dtype of the result. A floating point dtype gives the densities in percent, an integer dtype
+        (e.g. np.uint8) gives the neighbour counts.
+    :param n_workers: Number of threads to process the types in parallel (number of CPUs if None)
+    :return: array of shape (len(types), *veg_int.shape) with the layers in the order of types
+
+    usage example:
+    densities = vegetation_density(veg_int, [311, 312, 313])
+    """
+    size = 2*window_size + 1
+    lut = (100 * np.arange(size*size + 1) / (size*size)).astype(dtype)
+    as_counts = np.issubdtype(dtype, np.integer)
+
+    stack = np.empty((len(types), *veg_int.shape), dtype=dtype)
+    def fill(i):
+        counts = box_count(veg_int == types[i], window_size)
+        stack[i] = counts if as_counts else lut[counts]
+
+    if n_workers == 1:
+        for i in range(len(types)):
+            fill(i)
+    else:
+        with ThreadPoolExecutor(max_workers=n_workers or os.cpu_count()) as executor:
+            list(executor.map(fill, range(len(types))))
+    return stack
+
+
+@instrumented("feature_assembly")
 def assemble_veg_dictionary(veg_path, dem_path, verbose=False):
     """Assemble the dictionary with all the rasters to be used in the model which are related to vegetation.
     
@@ -304,10 +805,8 @@ def assemble_veg_dictionary(veg_path, dem_path, verbose=False):
     # Create the dictionary
     veg_dict = {}
     veg_dict["veg"] = MyRaster(veg_path, "veg")
-    veg_dict["veg"].read_raster()
     veg_arr = veg_dict["veg"].data.astype(int)
     dem_raster = MyRaster(dem_path, "dem")
-    dem_raster.read_raster()
     dem_arr = dem_raster.data
     dem_nodata = dem_raster.nodata
 
@@ -323,21 +822,17 @@ def assemble_veg_dictionary(veg_path, dem_path, verbose=False):
     # remove zero
     types = types[types != 0]
     if verbose:
-        print("types of vegetation in the veg raster:", types)
-
-    counter = np.ones((window_size*2+1, window_size*2+1))
-    take_center = 1
-    counter[window_size, window_size] = take_center
-    counter = counter / np.sum(counter)
+        log(f"types of vegetation in the veg raster: {types}")
 
-    # perc --> neighbouring vegetation generation
-    for t in tqdm(types, desc="processing vegetation density"):
+    # perc --> neighbouring vegetation generation, all the types at once
+    with stage("vegetation_density", types=len(types)):
+        densities = vegetation_density(veg_int, types, window_size, n_workers=None)
+    for t, temp_data in zip(types, densities):
         density_entry = 'perc_' + str(int(t))
-        if verbose:
-            print(f'Processing vegetation density {density_entry}')
-        temp_data = 100 * signal.convolve2d(veg_int==t, counter, boundary='fill', mode='same')
-        temp_raster = MyRaster(dem_path, density_entry) # the path is dummy... I need just the other metadata.
-        temp_raster.read_raster()
+        # the path is dummy... I need just the other metadata, taken from the dem already read.
+        temp_raster = MyRaster(dem_path, density_entry, read=False)
+        temp_raster.mask = dem_raster.mask
+        temp_raster.nodata = dem_raster.nodata
         temp_raster.set_data(temp_data)
         veg_dict[density_entry] = temp_raster
 
@@ -345,6 +840,7 @@ def assemble_veg_dictionary(veg_path, dem_path, verbose=False):
 
 
 
+@instrumented("feature_assembly")
 def preprocessing(dem_dict, veg_dict, climate_dict, fires_raster, mask, verbose=True):
     """
     Usage:
@@ -363,11 +859,11 @@ def preprocessing(dem_dict, veg_dict, climate_dict, fires_raster, mask, verbose=
     Y_all = fires_raster.data[mask]
 
     if verbose:
-        print('Creating dataset for RandomForestClassifier')
+        log('Creating dataset for RandomForestClassifier')
     columns = data_dict.keys()
-    for col, k in tqdm(enumerate(data_dict), "processing columns"):
+    for col, k in tqdm(enumerate(data_dict), "processing columns", disable=not verbose):
         if verbose:
-            print(f'Processing column: {k}')
+            log(f'Processing column: {k}')
         data = data_dict[k]
         # data is a MyRaster object and data.data is the numpy array with the data
         X_all[:, col] = data.data[mask]
@@ -375,51 +871,797 @@ def preprocessing(dem_dict, veg_dict, climate_dict, fires_raster, mask, verbose=
     return X_all, Y_all, columns
 
 
-def prepare_sample(X_all, Y_all, percentage=0.1, max_depth=8, number_of_trees=50):
+def raster_windows(reference_file, block_size=512):
+    """Split the grid of a raster into square windows, aligned with the internal tiles of the GeoTIFFs.
+
+    The rasters written by reproject_match_reference in the Hazard notebook are tiled in blocks of 512x512
+    pixels starting from the upper left corner, so with the default block_size every window reads whole tiles.
+
+    :param reference_file: Path to the raster which defines the grid
+    :param block_size: Size of the windows in pixels
+    :return: a list of rasterio.windows.Window covering the full raster, row by row
+    """
+    with rasterio.open(reference_file) as src:
+        height, width = src.shape
+    return [
+        Window(col, row, min(block_size, width - col), min(block_size, height - row))
+        for row in range(0, height, block_size)
+        for col in range(0, width, block_size)
+    ]
+
+
+def read_window(path, window, halo=0, fill_value=0):
+    """Read a window of the first band of a raster, extended by a halo of pixels on each side.
+
+    The parts of the (extended) window which fall outside of the raster are filled with fill_value.
+
+    :param path: Path to the raster, or 2D numpy array with the raster already in memory
+    :param window: rasterio.windows.Window to read
+    :param halo: Number of extra pixels to read on each side of the window
+    :param fill_value: Value for the pixels outside of the raster
+    :return: 2D numpy array of shape (window.height + 2*halo, window.width + 2*halo)
+    """
+    row_start, col_start = window.row_off - halo, window.col_off - halo
+    row_stop, col_stop = window.row_off + window.height + halo, window.col_off + window.width + halo
+    if isinstance(path, np.ndarray):
+        height, width = path.shape
+        data = path[max(row_start, 0):min(row_stop, height), max(col_start, 0):min(col_stop, width)]
+    else:
+        with rasterio.open(path) as src:
+            height, width = src.shape
+            inner = Window.from_slices((max(row_start, 0), min(row_stop, height)),
+                    (max(col_start, 0), min(col_stop, width)))
+            data = src.read(1, window=inner)
+    if halo == 0:
+        return data
+    if np.issubdtype(data.dtype, np.integer) and np.isnan(fill_value):
+        # an integer raster (e.g. a DEM with no nodata) cannot be padded with NaN
+        data = data.astype(np.float64)
+    pad =((max(-row_start, 0), max(row_stop - height, 0)), (max(-col_start, 0), max(col_stop - width, 0)))
+    return np.pad(data, pad, mode='constant', constant_values=fill_value)
+
+
+class FeatureTiles:
+    """Assemble the dataset of preprocessing() tile by tile, reading only one window of every raster at a time.
+
+    The columns are the same of preprocessing(): the dem layers, the vegetation raster, the vegetation densities
+    (perc_* layers, see assemble_veg_dictionary) and the climate layers. Valid pixels have a vegetation type
+    different from 0 and a DEM value different from the DEM nodata.
+    The vegetation densities are computed on the window extended by window_size pixels, so that they are
+    the same as the ones computed on the full raster.
+
+    The dem layers other than "dem" can also be 2D arrays already in memory, e.g. from terrain_derivatives.
+    If a static_store (see static_feature_store) is given, the dem and vegetation columns and the valid pixels
+    are taken from it, and only the climate layers (and fires) are read from the rasters.
+
+    usage example:
+    dem_paths = {"dem": dem_path, "slope": slope_path, "aspect": aspect_path, "easting": easting_path,
+                 "northing": northing_path, "roughness": roughness_path}
+    climate_paths = {"MWMT": mwmt_path, "TD": td_path, ...}
+    feature_tiles = FeatureTiles(dem_paths, veg_path, climate_paths, fires_path)
+    for X_tile, Y_tile, pixel_index in feature_tiles:
+        ...
+    """
+    def __init__(self, dem_paths, veg_path, climate_paths, fires_path=None, veg_types=None, window_size=2,
+            block_size=512, static_store=None):
+        self.dem_paths = dict(dem_paths)
+        self.veg_path = veg_path
+        self.climate_paths = dict(climate_paths)
+        self.fires_path = fires_path
+        self.window_size = window_size
+        self.static_store = static_store
+        if static_store is not None:
+            block_size = static_store["block_size"]
+            veg_types = [col[len('perc_'):] for col in static_store["columns"] if col.startswith('perc_')]
+        self.block_size = block_size
+        with rasterio.open(self.dem_paths["dem"]) as src:
+            self.shape = src.shape
+            self.dem_nodata = src.nodata
+        self.windows = raster_windows(self.dem_paths["dem"], block_size)
+        if veg_types is None:
+            veg_types = self.find_veg_types()
+        self.veg_types = [int(t) for t in veg_types]
+        self.static_columns = [*self.dem_paths, "veg", *[f"perc_{t}" for t in self.veg_types]]
+        self.columns = [*self.static_columns, *self.climate_paths]
+        if static_store is not None and static_store["columns"] != self.static_columns:
+            raise ValueError(f'static store columns {static_store["columns"]} do not match {self.static_columns}')
+
+    def __len__(self):
+        return len(self.windows)
+
+    def __iter__(self):
+        for window in self.windows:
+            X_tile, Y_tile, pixel_index = self.read(window)
+            if len(pixel_index) > 0:
+                yield X_tile, Y_tile, pixel_index
+
+    def window_number(self, window):
+        """Position of a window in the list of windows"""
+        n_cols = -(-self.shape[1] // self.block_size)
+        return (window.row_off // self.block_size) * n_cols + window.col_off // self.block_size
+
+    def read_veg(self, window, halo=0):
+        """Read the vegetation types of a window (with halo), 0 where the pixel is not valid"""
+        veg = read_window(self.veg_path, window, halo=halo, fill_value=0).astype(int)
+        dem = read_window(self.dem_paths["dem"], window, halo=halo, fill_value=self.dem_nodata)
+        return np.where((veg != 0) & (dem != self.dem_nodata), veg, 0)
+
+    def find_veg_types(self):
+        """Collect the vegetation types of all the valid pixels, reading one window at a time"""
+        types = set()
+        for window in self.windows:
+            types.update(np.unique(self.read_veg(window)).tolist())
+        types.discard(0)
+        return sorted(types)
+
+    def count_valid(self):
+        """Count the valid pixels of every window"""
+        if self.static_store is not None:
+            return np.diff(self.static_store["tile_offsets"])
+        return np.array([np.count_nonzero(self.read_veg(window)) for window in self.windows], dtype=np.int64)
+
+    def valid_pixels(self, window):
+        """Rows and cols (inside the window) of the valid pixels of a window, without reading the features"""
+        if self.static_store is None:
+            return np.nonzero(self.read_veg(window))
+        number = self.window_number(window)
+        start, stop = self.static_store["tile_offsets"][number:number + 2]
+        pixel_index = np.asarray(self.static_store["pixel_index"][start:stop])
+        return pixel_index // self.shape[1] - window.row_off, pixel_index % self.shape[1] - window.col_off
+
+    def read_static(self, window):
+        """Compute the dem and vegetation columns of the valid pixels of a window.
+
+        :return: the static columns (valid pixels x static features) and the rows and cols of the valid pixels
+            inside the window
+        """
+        halo = self.window_size
+        veg_int = self.read_veg(window, halo=halo)
+        inner = veg_int[halo:halo + window.height, halo:halo + window.width]
+        valid = inner != 0
+        rows, cols = np.nonzero(valid)
+
+        X_static = np.zeros((len(rows), len(self.static_columns)), dtype=np.float32)
+        col = 0
+        for path in self.dem_paths.values():
+            X_static[:, col] = read_window(path, window)[valid]
+            col += 1
+        X_static[:, col] = inner[valid]
+        col += 1
+        densities = vegetation_density(veg_int, self.veg_types, self.window_size)
+        for density in densities[:, halo:halo + window.height, halo:halo + window.width]:
+            X_static[:, col] = density[valid]
+            col += 1
+        return X_static, rows, cols
+
+    def load_static(self, window):
+        """Load the dem and vegetation columns of the valid pixels of a window from the static store"""
+        number = self.window_number(window)
+        start, stop = self.static_store["tile_offsets"][number:number + 2]
+        pixel_index = np.asarray(self.static_store["pixel_index"][start:stop])
+        rows = pixel_index // self.shape[1] - window.row_off
+        cols = pixel_index % self.shape[1] - window.col_off
+        return np.asarray(self.static_store["X"][start:stop]), rows, cols
+
+    def read(self, window):
+        """Read the features of the valid pixels of a window.
+
+        :param window: rasterio.windows.Window to read
+        :return: X_tile (valid pixels x features, float32), Y_tile (fires value of the valid pixels, None if
+            no fires_path is given), pixel_index (flat index of the valid pixels in the full raster)
+        """
+        if self.static_store is None:
+            X_static, rows, cols = self.read_static(window)
+        else:
+            X_static, rows, cols = self.load_static(window)
+        pixel_index = (rows + window.row_off).astype(np.int64) * self.shape[1] + (cols + window.col_off)
+
+        X_tile = np.zeros((len(pixel_index), len(self.columns)), dtype=np.float32)
+        X_tile[:, :X_static.shape[1]] = X_static
+        for col, path in enumerate(self.climate_paths.values(), start=X_static.shape[1]):
+            X_tile[:, col] = read_window(path, window)[rows, cols]
+
+        Y_tile = None if self.fires_path is None else read_window(self.fires_path, window)[rows, cols]
+        return X_tile, Y_tile, pixel_index
+
+
+@instrumented("feature_assembly")
+def build_feature_store(store_dir, feature_tiles, verbose=True):
+    """Write the dataset assembled by a FeatureTiles object to memory-mapped .npy files.
+
+    The store contains X.npy (valid pixels x features, float32), Y.npy (fires value of the valid pixels, only
+    if the FeatureTiles has a fires_path), pixel_index.npy (flat index of the valid pixels in the full raster),
+    tile_offsets.npy (first row of every window of feature_tiles.windows) and meta.json.
+    Only one window is held in memory at a time.
+
+    :param store_dir: Path to the folder of the store
+    :param feature_tiles: FeatureTiles object
+    :param verbose: If True, show the progress
+    :return: the store opened with open_feature_store
+
+    usage example:
+    store = build_feature_store(store_dir, FeatureTiles(dem_paths, veg_path, climate_paths, fires_path))
+    X_all, Y_all, columns = store["X"], store["Y"], store["columns"]
+    """
+    os.makedirs(store_dir, exist_ok=True)
+    counts = feature_tiles.count_valid()
+    tile_offsets = np.concatenate([[0], np.cumsum(counts)])
+    n_pixels, n_features = int(tile_offsets[-1]), len(feature_tiles.columns)
+
+    X = np.lib.format.open_memmap(os.path.join(store_dir, "X.npy"), mode='w+', dtype=np.float32,
+            shape=(n_pixels, n_features))
+    pixel_index = np.lib.format.open_memmap(os.path.join(store_dir, "pixel_index.npy"), mode='w+',
+            dtype=np.int64, shape=(n_pixels,))
+    Y = None
+    if feature_tiles.fires_path is not None:
+        Y = np.lib.format.open_memmap(os.path.join(store_dir, "Y.npy"), mode='w+', dtype=np.float32,
+                shape=(n_pixels,))
+    np.save(os.path.join(store_dir, "tile_offsets.npy"), tile_offsets)
+
+    windows = zip(feature_tiles.windows, tile_offsets[:-1], tile_offsets[1:])
+    for window, start, stop in tqdm(windows, total=len(feature_tiles), desc="assembling features",
+            disable=not verbose):
+        if start == stop:
+            continue
+        X_tile, Y_tile, tile_index = feature_tiles.read(window)
+        X[start:stop] = X_tile
+        pixel_index[start:stop] = tile_index
+        if Y is not None:
+            Y[start:stop] = Y_tile
+    X.flush()
+    pixel_index.flush()
+    if Y is not None:
+        Y.flush()
+    del X, Y, pixel_index
+
+    meta = {
+        "columns": list(feature_tiles.columns),
+        "shape": list(feature_tiles.shape),
+        "block_size": feature_tiles.block_size,
+    }
+    with open(os.path.join(store_dir, "meta.json"), 'w', encoding='utf-8') as f:
+        json.dump(meta, f, indent=2)
+    return open_feature_store(store_dir)
+
+
+def open_feature_store(store_dir, mode='r'):
+    """Open a store written by build_feature_store without loading it in memory.
+
+    :param store_dir: Path to the folder of the store
+    :param mode: mmap_mode of the arrays
+    :return: a dictionary with the arrays "X", "Y" (None if not stored), "pixel_index", "tile_offsets",
+        the metadata "columns", "shape" and "block_size" and the "store_dir" (e.g. to open it in other processes)
+    """
+    with open(os.path.join(store_dir, "meta.json"), encoding='utf-8') as f:
+        store = json.load(f)
+    store["shape"] = tuple(store["shape"])
+    store["store_dir"] = str(store_dir)
+    for name in ["X", "Y", "pixel_index"]:
+        path = os.path.join(store_dir, f"{name}.npy")
+        store[name] = np.load(path, mmap_mode=mode) if os.path.exists(path) else None
+    store["tile_offsets"] = np.load(os.path.join(store_dir, "tile_offsets.npy"))
+    return store
+
+
+@functools.lru_cache(maxsize=None)
+def _file_checksum(path, size, mtime_ns):  # pylint: disable=unused-argument
+    sha = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(2**24), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+
+def file_checksum(path):
+    """SHA-256 checksum of the content of a file (or of a numpy array).
+
+    The checksum of a file is computed once per session for every version (size and modification time) of it.
+    """
+    if isinstance(path, np.ndarray):
+        # a raster already in memory (see terrain_derivatives)
+        return hashlib.sha256(np.ascontiguousarray(path).view(np.uint8)).hexdigest()
+    path = os.path.abspath(path)
+    stat = os.stat(path)
+    return _file_checksum(path, stat.st_size, stat.st_mtime_ns)
+
+
+def _cache_key(key):
+    """Short hash of a description (JSON serializable) of the inputs and parameters of a cached result"""
+    return hashlib.sha256(json.dumps(key, sort_keys=True).encode()).hexdigest()[:16]
+
+
+def static_feature_store(cache_dir, dem_paths, veg_path, veg_types=None, window_size=2, block_size=512,
+        verbose=True):
+    """Build (once) and open the store of the static features: dem layers, vegetation and vegetation densities.
+
+    The store is saved in a subfolder of cache_dir named after a hash of the checksums of the input files and
+    of the processing parameters, so it is reused by the training and by every climate scenario as long as
+    the inputs do not change. Pass it as static_store to FeatureTiles to read only the climate layers.
+
+    :param cache_dir: Path to the folder of the cache
+    :param dem_paths: dictionary with the labels and paths (or arrays) of the dem layers (see FeatureTiles)
+    :param veg_path: path to the vegetation raster
+    :param veg_types: vegetation types for the densities (all types found in the raster by default)
+    :param window_size: half size of the window of the vegetation densities
+    :param block_size: size of the windows in pixels
+    :param verbose: If True, show the progress
+    :return: the store opened with open_feature_store
+
+    usage example:
+    static_store = static_feature_store(cache_dir, dem_paths, veg_path)
+    feature_tiles = FeatureTiles(dem_paths, veg_path, climate_paths, static_store=static_store)
+    """
+    key = {
+        "dem": {label: file_checksum(path) for label, path in dem_paths.items()},
+        "veg": file_checksum(veg_path),
+        "veg_types": None if veg_types is None else [int(t) for t in veg_types],
+        "window_size": window_size,
+        "block_size": block_size,
+    }
+    store_dir = os.path.join(cache_dir, _cache_key(key))
+    if os.path.exists(os.path.join(store_dir, "meta.json")):
+        if verbose:
+            log(f'Using static features from {store_dir}')
+        return open_feature_store(store_dir)
+
+    # build in a temporary folder, so that an interrupted run is never taken for a complete store
+    tmp_dir = f"{store_dir}.tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    feature_tiles = FeatureTiles(dem_paths, veg_path, {}, veg_types=veg_types, window_size=window_size,
+            block_size=block_size)
+    build_feature_store(tmp_dir, feature_tiles, verbose=verbose)
+    shutil.rmtree(store_dir, ignore_errors=True)
+    os.replace(tmp_dir, store_dir)
+    return open_feature_store(store_dir)
+
+
+def training_key(dem_paths, veg_path, climate_paths, fires_path, **params):
+    """Key of the training of a model: a hash of the checksums of its input files and of its parameters.
+
+    As for static_feature_store, a model saved under a name containing the key (e.g. model_HIST_199110_<key>.npz)
+    is only reused when neither the inputs nor the parameters changed.
+
+    :param dem_paths: dictionary with the labels and paths of the dem layers (see FeatureTiles)
+    :param veg_path: path to the vegetation raster
+    :param climate_paths: dictionary with the labels and paths of the climate layers
+    :param fires_path: path to the fires raster
+    :param params: parameters of the training (e.g. percentage, max_depth, number_of_trees, seed)
+    :return: key of 16 hexadecimal characters
+
+    usage example:
+    key = training_key(dem_paths, veg_path, climate_paths, fires_path, max_depth=10, number_of_trees=100)
+    model_path = suscep_path / f"model_HIST_{hist_period}_{key}.npz"
+    """
+    return _cache_key({
+        "dem": {label: file_checksum(path) for label, path in dem_paths.items()},
+        "veg": file_checksum(veg_path),
+        "climate": {label: file_checksum(path) for label, path in climate_paths.items()},
+        "fires": file_checksum(fires_path),
+        "params": params,
+    })
+
+def map_windows(func, windows, n_workers=None):
+    """Apply a function to a list of windows in a pool of threads.
+
+    At most 2*n_workers windows are processed or waiting at the same time, so the results do not pile up in
+    memory when they are consumed more slowly than they are produced.
+
+    :param func: Function taking a window as argument
+    :param windows: Iterable of rasterio.windows.Window
+    :param n_workers: Number of threads (number of CPUs by default)
+    :return: a generator of (window, func(window)) tuples, in order of completion
+    """
+    n_workers = n_workers or os.cpu_count()
+    with ThreadPoolExecutor(max_workers=n_workers) as executor:
+        pending = set()
+        for window in windows:
+            pending.add(executor.submit(lambda w: (w, func(w)), window))
+            if len(pending) >= 2 * n_workers:
+                done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    yield future.result()
+        while pending:
+            done, pending = wait(pending, return_when=FIRST_COMPLETED)
+            for future in done:
+                yield future.result()
+
+
+@numba.njit(nogil=True, cache=True)
+def _forest_proba(X, roots, depths, child, feature, threshold, missing_left, value, out, lanes=256):
+    """Sum the leaf values of all the trees for every row of X into out, then average (see CompiledForest)
+
+    The rows are evaluated by groups of lanes, tree by tree and one level at a time for the whole group: the
+    steps of different rows do not depend on each other, so they overlap instead of waiting for the previous
+    node of the same row (the descent of a single row is a chain of dependent loads).
+    """
+    n_trees, n_classes = len(roots), value.shape[1]
+    nodes = np.empty(lanes, dtype=child.dtype)
+    for start in range(0, X.shape[0], lanes):
+        n_rows = min(lanes, X.shape[0] - start)
+        for tree in range(n_trees):
+            nodes[:n_rows] = roots[tree]
+            # no branches: the two children are consecutive and the leaves point to themselves
+            for _ in range(depths[tree]):
+                for i in range(n_rows):
+                    node = nodes[i]
+                    x = X[start + i, feature[node]]
+                    nodes[i] = child[node] + ((x > threshold[node]) | (np.isnan(x) & (missing_left[node] == 0)))
+            for i in range(n_rows):
+                for c in range(n_classes):
+                    out[start + i, c] += value[nodes[i], c]
+        for i in range(n_rows):
+            for c in range(n_classes):
+                out[start + i, c] /= n_trees
+
+
+def _float32_floor(values):
+    """Largest float32 not greater than every value: x <= value is the same as x <= floor for float32 x"""
+    values32 = values.astype(np.float32)
+    return np.where(values32.astype(np.float64) > values, np.nextafter(values32, np.float32(-np.inf)), values32)
+
+
+class CompiledForest:
+    """Random forest classifier exported to flat node arrays, evaluated with a compiled kernel.
+
+    The nodes of all the trees are concatenated and numbered breadth first, so that the children of a node are
+    consecutive (child is the first one, -1 is never used: the leaves point to themselves). Every node has a
+    feature, a threshold (rounded down to float32, which gives the same splits for the float32 features), the
+    side of the missing values and the class probabilities (used for the leaves).
+    predict_proba gives the same result as the predict_proba of the forest, with no temporary array per tree,
+    and releases the GIL so blocks of pixels are evaluated in parallel threads (e.g. by predict_to_raster).
+    A compiled forest is saved to a .npz file and loaded back without unpickling the forest.
+
+    usage example:
+    compiled_model = compile_forest(model)
+    compiled_model.save(model_path)
+    predict_to_raster(CompiledForest.load(model_path), feature_tiles, suscep_path)
+    """
+    arrays = ["roots", "depths", "child", "feature", "threshold", "missing_left", "value", "classes_"]
+
+    def __init__(self, roots, depths, child, feature, threshold, missing_left, value, classes_):
+        self.roots = roots
+        self.depths = depths
+        self.child = child
+        self.feature = feature
+        self.threshold = threshold
+        self.missing_left = missing_left
+        self.value = value
+        self.classes_ = classes_
+
+    def predict_proba(self, X, n_workers=1, block_size=65536):
+        """Class probabilities of the rows of X, as RandomForestClassifier.predict_proba
+
+        :param X: 2D array (rows x features), converted to float32 as in sklearn
+        :param n_workers: Number of threads, every one evaluating blocks of block_size rows
+        :param block_size: Number of rows of a block
+        :return: 2D float64 array (rows x classes)
+        """
+        X = np.ascontiguousarray(X, dtype=np.float32)
+        out = np.zeros((X.shape[0], len(self.classes_)), dtype=np.float64)
+
+        def evaluate(start):
+            _forest_proba(X[start:start + block_size], self.roots, self.depths, self.child, self.feature,
+                    self.threshold, self.missing_left, self.value, out[start:start + block_size])
+
+        starts = range(0, X.shape[0], block_size)
+        if n_workers == 1 or len(starts) <= 1:
+            for start in starts:
+                evaluate(start)
+        else:
+            with ThreadPoolExecutor(max_workers=n_workers or os.cpu_count()) as executor:
+                list(executor.map(evaluate, starts))
+        return out
+
+    def save(self, path):
+        """Save the node arrays to a .npz file"""
+        np.savez(path, **{name: getattr(self, name) for name in self.arrays})
+
+    @classmethod
+    def load(cls, path):
+        """Load a compiled forest saved with save"""
+        with np.load(path) as data:
+            return cls(**{name: data[name] for name in cls.arrays})
+
+
+def _breadth_first(tree):
+    """Nodes of a sklearn tree in breadth first order (the two children of a node are consecutive)"""
+    order, level = [], np.array([0])
+    while level.size:
+        order.append(level)
+        internal = level[tree.children_left[level] != -1]
+        level = np.stack([tree.children_left[internal], tree.children_right[internal]], axis=1).ravel()
+    return np.concatenate(order)
+
+
+def compile_forest(model):
+    """Export a fitted RandomForestClassifier (see prepare_sample) to a CompiledForest.
+
+    :param model: fitted random forest classifier with a single output
+    :return: CompiledForest giving the same predict_proba
+    """
+    n_classes = len(model.classes_)
+    nodes = {name: [] for name in CompiledForest.arrays[2:-1]}
+    roots, depths, offset = [], [], 0
+    for estimator in model.estimators_:
+        tree = estimator.tree_
+        order = _breadth_first(tree)
+        number = np.empty(tree.node_count, dtype=np.int64)
+        number[order] = np.arange(tree.node_count) + offset
+        leaf = tree.children_left[order] == -1
+        nodes["child"].append(np.where(leaf, number[order], number[np.where(leaf, 0, tree.children_left[order])]))
+        nodes["feature"].append(np.where(leaf, 0, tree.feature[order]))
+        nodes["threshold"].append(np.where(leaf, np.inf, tree.threshold[order]))
+        missing_left = getattr(tree, 'missing_go_to_left', np.zeros(tree.node_count, dtype=np.uint8))
+        nodes["missing_left"].append(np.where(leaf, 1, missing_left[order]))
+        # class probabilities of the leaves, normalized as in DecisionTreeClassifier.predict_proba
+        value = tree.value[order, 0, :n_classes].astype(np.float64)
+        normalizer = value.sum(axis=1, keepdims=True)
+        normalizer[normalizer == 0.0] = 1.0
+        nodes["value"].append(value / normalizer)
+        roots.append(offset)
+        depths.append(tree.max_depth)
+        offset += tree.node_count
+
+    return CompiledForest(
+        roots=np.array(roots, dtype=np.uint32),
+        depths=np.array(depths, dtype=np.uint32),
+        child=np.concatenate(nodes["child"]).astype(np.uint32),
+        feature=np.concatenate(nodes["feature"]).astype(np.uint32),
+        threshold=_float32_floor(np.concatenate(nodes["threshold"])),
+        missing_left=np.concatenate(nodes["missing_left"]).astype(np.uint8),
+        value=np.concatenate(nodes["value"]),
+        classes_=np.asarray(model.classes_),
+    )
+
+
+@instrumented("inference")
+def predict_to_raster(model, feature_tiles, output_file, fill_value=np.nan, n_workers=None, verbose=True,
+        product="continuous", **kwargs):
+    """Evaluate the model on all the valid pixels and write the probability of fire directly to a GeoTIFF.
+
+    The windows of feature_tiles are evaluated in parallel and every window is written to the output raster as
+    soon as it is ready, so neither the full dataset nor the full output raster is ever held in memory.
+    The probabilities are written as float32 (see RASTER_PRODUCTS and RasterWriter), so that the quantiles and
+    the classes of the susceptibility are the same as those of the prediction. The pixels which are not valid
+    get fill_value, which is no data: read_raster(output_file, fill_value=-1) gives the -1 of get_results of the
+    Hazard notebook.
+
+    :param model: Fitted classifier (see prepare_sample) or CompiledForest (see compile_forest)
+    :param feature_tiles: FeatureTiles object with the same columns used to fit the model
+    :param output_file: Path to the output raster
+    :param fill_value: Value of the pixels which are not valid (no data by default)
+    :param n_workers: Number of windows evaluated at the same time (number of CPUs by default)
+    :param verbose: If True, show the progress
+    :param product: name of the product in RASTER_PRODUCTS ("probability" for a compact uint8 map)
+    :param kwargs: Keyword arguments of RasterWriter
+
+    usage example:
+    predict_to_raster(model, FeatureTiles(dem_paths, veg_path, climate_paths), suscep_path)
+    """
+    width = feature_tiles.shape[1]
+    if feature_tiles.block_size % 16 == 0:
+        kwargs.setdefault('block_size', feature_tiles.block_size)
+
+    def predict_window(window):
+        X_tile, _, pixel_index = feature_tiles.read(window)
+        out = np.full((window.height, window.width), fill_value, dtype=np.float32)
+        if len(pixel_index) > 0:
+            rows = pixel_index // width - window.row_off
+            cols = pixel_index % width - window.col_off
+            out[rows, cols] = model.predict_proba(X_tile)[:, 1]
+        return out
+
+    # the forest would log every single window
+    model_verbose = getattr(model, 'verbose', 0)
+    if model_verbose:
+        model.set_params(verbose=0)
+    try:
+        with RasterWriter(output_file, feature_tiles.dem_paths["dem"], product, **kwargs) as writer:
+            tiles = map_windows(predict_window, feature_tiles.windows, n_workers)
+            for window, out in tqdm(tiles, total=len(feature_tiles), desc="predicting", disable=not verbose):
+                writer.write(out, window)
+    finally:
+        if model_verbose:
+            model.set_params(verbose=model_verbose)
+
+
+def _draw_ranks(rng, total, size):
+    """Sorted ranks of size items drawn without replacement among total items"""
+    return np.sort(rng.choice(total, size=size, replace=False))
+
+
+@instrumented("sampling")
+def sample_pixels(feature_tiles, percentage=0.1, strata=None, seed=None, n_workers=None, verbose=True):
+    """Draw the presence (burned) and pseudo-absence pixels of the training set, working on pixel indices only.
+
+    As in prepare_sample, a percentage of the burned pixels are drawn as presences, and as many valid pixels
+    which did not burn as pseudo-absences. With strata (e.g. the fuel types or a raster of regions), the
+    drawing is done in every stratum separately, so that the pseudo-absences follow the presences.
+    The windows of feature_tiles are scanned twice (counting, then drawing) and only the fires, the validity
+    and the strata are read: the memory used is of the size of a window and of the sample, not of the region.
+    Without strata, the pixels are the same as those of prepare_sample on the feature store with the same seed.
+
+    :param feature_tiles: FeatureTiles object with a fires_path
+    :param percentage: the percentage of the burned pixels to be used for training
+    :param strata: Path to a raster (or 2D array) with the integer stratum of every pixel, None for no strata
+    :param seed: seed of the random generator
+    :param n_workers: Number of threads (number of CPUs by default)
+    :param verbose: If True, print the number of pixels
+    :return: presence and absence, arrays with the flat indices of the drawn pixels in the full raster,
+        in the order of the rows of a feature store built from feature_tiles
+    """
+    if feature_tiles.fires_path is None:
+        raise ValueError('feature_tiles has no fires_path')
+    windows = feature_tiles.windows
+
+    def classes(window):
+        rows, cols = feature_tiles.valid_pixels(window)
+        fires = read_window(feature_tiles.fires_path, window)[rows, cols] != 0
+        if strata is None:
+            stratum = np.zeros(len(rows), dtype=np.int64)
+        else:
+            stratum = read_window(strata, window)[rows, cols].astype(np.int64)
+        pixel_index = (rows + window.row_off).astype(np.int64) * feature_tiles.shape[1] + (cols + window.col_off)
+        return pixel_index, fires, stratum
+
+    def count(window):
+        _, fires, stratum = classes(window)
+        return [np.unique(stratum[fires == presence], return_counts=True) for presence in (True, False)]
+
+    # first pass: number of presences and absences of every stratum in every window
+    counts = {}
+    for window, window_counts in map_windows(count, windows, n_workers):
+        number = feature_tiles.window_number(window)
+        for presence, (labels, n_pixels) in zip((True, False), window_counts):
+            for label, n in zip(labels.tolist(), n_pixels):
+                counts.setdefault((label, presence), np.zeros(len(windows), dtype=np.int64))[number] = n
+
+    # draw the ranks of the pixels in every stratum, and split them by window
+    rng = np.random.default_rng(seed)
+    selected = {}
+    for label in sorted({label for label, _ in counts}):
+        no_pixels = np.zeros(len(windows), dtype=np.int64)
+        presence_counts, absence_counts = counts.get((label, True), no_pixels), counts.get((label, False), no_pixels)
+        size = int(presence_counts.sum() * percentage)
+        for presence, window_counts in ((True, presence_counts), (False, absence_counts)):
+            offsets = np.concatenate([[0], np.cumsum(window_counts)])
+            ranks = _draw_ranks(rng, offsets[-1], min(size, offsets[-1]))
+            bounds = np.searchsorted(ranks, offsets)
+            for number in np.flatnonzero(np.diff(bounds)):
+                local_ranks = ranks[bounds[number]:bounds[number + 1]] - offsets[number]
+                selected.setdefault(number, []).append((label, presence, local_ranks))
+
+    # second pass: flat index of the drawn pixels, only in the windows where something was drawn
+    def pick(window):
+        pixel_index, fires, stratum = classes(window)
+        picked = {True: [], False: []}
+        for label, presence, local_ranks in selected[feature_tiles.window_number(window)]:
+            picked[presence].append(pixel_index[(stratum == label) & (fires == presence)][local_ranks])
+        # the strata are drawn one after the other: back to the order of the pixels in the window
+        return {kind: [np.sort(np.concatenate(indices))] if indices else [] for kind, indices in picked.items()}
+
+    picked = {}
+    for window, window_picked in map_windows(pick, [windows[number] for number in sorted(selected)], n_workers):
+        picked[feature_tiles.window_number(window)] = window_picked
+    presence, absence = [
+        np.concatenate([np.empty(0, dtype=np.int64),
+                        *[np.concatenate(picked[number][kind]) for number in sorted(picked)
+                          if picked[number][kind]]])
+        for kind in (True, False)
+    ]
+    if verbose:
+        n_burned = sum(n.sum() for (_, kind), n in counts.items() if kind)
+        log(f'Number of burned points: {n_burned}')
+        log(f'Sampled {len(presence)} presences and {len(absence)} pseudo-absences')
+    return presence, absence
+
+
+@instrumented("sampling")
+def gather_features(source, pixel_index, n_workers=None):
+    """Read the features of some pixels (e.g. from sample_pixels), one window at a time.
+
+    Only the windows containing some of the pixels are read, and only the rows of the pixels are kept, so the
+    memory used is of the size of a window and of the result.
+
+    :param source: FeatureTiles object (the features are read from the rasters, or from its static store and
+        the climate rasters) or a feature store opened with open_feature_store
+    :param pixel_index: flat indices of valid pixels in the full raster
+    :param n_workers: Number of threads (number of CPUs by default)
+    :return: 2D float32 array (pixels x features), in the order of pixel_index
+    """
+    from_tiles = isinstance(source, FeatureTiles)
+    if from_tiles:
+        shape, block_size, n_features = source.shape, source.block_size, len(source.columns)
+    else:
+        shape, block_size, n_features = source["shape"], source["block_size"], len(source["columns"])
+    pixel_index = np.asarray(pixel_index, dtype=np.int64)
+    rows, cols = np.divmod(pixel_index, shape[1])
+    n_cols = -(-shape[1] // block_size)
+    numbers = (rows // block_size) * n_cols + cols // block_size
+    order = np.argsort(numbers, kind='stable')
+    bounds = np.searchsorted(numbers[order], np.arange(-(-shape[0] // block_size) * n_cols + 1))
+
+    def read(number):
+        positions = order[bounds[number]:bounds[number + 1]]
+        if from_tiles:
+            X_tile, _, tile_index = source.read(source.windows[number])
+        else:
+            start, stop = source["tile_offsets"][number:number + 2]
+            tile_index = np.asarray(source["pixel_index"][start:stop])
+        found = np.searchsorted(tile_index, pixel_index[positions])
+        if np.any(found == len(tile_index)) or np.any(tile_index[found] != pixel_index[positions]):
+            raise ValueError(f'some pixels of window {number} are not valid pixels')
+        return positions, X_tile[found] if from_tiles else np.asarray(source["X"][start + found])
+
+    X = np.empty((len(pixel_index), n_features), dtype=np.float32)
+    for _, (positions, X_rows) in map_windows(read, np.flatnonzero(np.diff(bounds)), n_workers):
+        X[positions] = X_rows
+    return X
+
+
+def _sample_model(X_presence, X_absence, max_depth, number_of_trees):
+    """Balanced training and testing datasets and random forest model, see prepare_sample"""
+    # create X and Y with presences and pseudo-absences
+    X = np.concatenate([X_presence, X_absence], axis=0)
+    Y = np.concatenate([np.ones((X_presence.shape[0],)), np.zeros((X_absence.shape[0],))])
+    # create training and testing df with random sampling
+    X_train, X_test, y_train, y_test = train_test_split(X, Y, test_size=0.33, random_state=42)
+
+    log(f'Running RF on data sample: {X_train.shape}')
+    model  = RandomForestClassifier(n_estimators=number_of_trees, max_depth = max_depth)
+
+    return model, X_train, X_test, y_train, y_test
+
+
+@instrumented("sampling")
+def prepare_sample(X_all, Y_all, percentage=0.1, max_depth=8, number_of_trees=50, seed=None):
     """
     Usage:
     model, X_train, X_test, y_train, y_test = train(X_all, Y_all, percentage)
     
     parameters:
-    X_all: the X dataset with the descriptive features
+    X_all: the X dataset with the descriptive features (can be memory-mapped, only the sampled rows are read)
     Y_all: the Y dataset with the target variable (burned or not burned)
     percentage: the percentage of the dataset to be used for training
     max_depth: random forest parameter
     number_of_trees: random forest parameter
+    seed: seed of the random generator of the sampling
     """
     # filter df taking info in the burned points
-    fires_rows = Y_all.data != 0
-    print(f'Number of burned points: {np.sum(fires_rows)}')
-    X_presence = X_all[fires_rows]
+    fires_rows = np.flatnonzero(np.ma.getdata(Y_all) != 0)
+    n_absence = len(Y_all) - len(fires_rows)
+    log(f'Number of burned points: {len(fires_rows)}')
 
     # sampling training set
-    print(' I am random sampling the dataset ')
+    log(' I am random sampling the dataset ')
     # reduction of burned points --> reduction of training points
-    reduction = int((X_presence.shape[0]*percentage))
-    print(f"reducted df points: {reduction} of {X_presence.shape[0]}")
-
-    # sampling and update presences
-    X_presence_indexes = np.random.choice(X_presence.shape[0], size=reduction, replace=False)
-
-    X_presence = X_presence[X_presence_indexes, :]
-    # select not burned points
+    reduction = int(len(fires_rows) * percentage)
+    log(f"reducted df points: {reduction} of {len(fires_rows)}")
+
+    # sampling presences and not burned points on the row indices only, then read just the sampled rows
+    rng = np.random.default_rng(seed)
+    presence_rows = fires_rows[_draw_ranks(rng, len(fires_rows), reduction)]
+    absence_ranks = _draw_ranks(rng, n_absence, min(reduction, n_absence))
+    # row of the r-th not burned point: r plus the number of burned rows before it
+    absence_rows = absence_ranks + np.searchsorted(fires_rows - np.arange(len(fires_rows)), absence_ranks,
+            side='right')
+    log(f"X_absence.shape[0] {len(absence_rows)}")
+    log(f"X_presence.shape[0] {len(presence_rows)}")
+    return _sample_model(X_all[presence_rows], X_all[absence_rows], max_depth, number_of_trees)
+
+
+@instrumented("sampling")
+def prepare_sample_tiles(feature_tiles, percentage=0.1, max_depth=8, number_of_trees=50, strata=None, seed=None,
+        n_workers=None):
+    """Same as prepare_sample, drawing the pixels with sample_pixels and reading only their features.
 
-    X_absence = X_all[~fires_rows] #why it is zero?
-    print("X_absence.shape[0]", X_absence.shape[0])
-    print("X_presence.shape[0]", X_presence.shape[0])
-    X_absence_choices_indexes = np.random.choice(X_absence.shape[0], size=X_presence.shape[0], replace=False)
-
-    X_pseudo_absence = X_absence[X_absence_choices_indexes, :]
-    # create X and Y with same number of burned and not burned points
-    X = np.concatenate([X_presence, X_pseudo_absence], axis=0)
-    Y = np.concatenate([np.ones((X_presence.shape[0],)), np.zeros((X_presence.shape[0],))])
-    # create training and testing df with random sampling
-    X_train, X_test, y_train, y_test = train_test_split(X, Y, test_size=0.33, random_state=42)
-
-    print(f'Running RF on data sample: {X_train.shape}')
-    model  = RandomForestClassifier(n_estimators=number_of_trees, max_depth = max_depth, verbose = 2)
-
-    return model, X_train, X_test, y_train, y_test
+    usage example:
+    feature_tiles = FeatureTiles(dem_paths, veg_path, climate_paths, fires_path, static_store=static_store)
+    model, X_train, X_test, y_train, y_test = prepare_sample_tiles(feature_tiles, percentage=0.1, seed=42)
+    """
+    presence, absence = sample_pixels(feature_tiles, percentage, strata=strata, seed=seed, n_workers=n_workers)
+    return _sample_model(gather_features(feature_tiles, presence, n_workers),
+            gather_features(feature_tiles, absence, n_workers), max_depth, number_of_trees)
 
 
 def fit_and_print_stats(model, X_train, y_train, X_test, y_test, columns):
@@ -437,68 +1679,232 @@ def fit_and_print_stats(model, X_train, y_train, X_test, y_test, columns):
     fit_and_print_stats(model, X_train, y_train, X_test, y_test, columns)
     """
     # fit model
-    model.fit(X_train, y_train)
+    with stage("fit", rows=len(X_train)):
+        model.fit(X_train, y_train)
     # stats on training df
     p_train = model.predict_proba(X_train)[:,1]
 
     auc_train = sklearn.metrics.roc_auc_score(y_train, p_train)
-    print(f'AUC score on train: {auc_train:.2f}')
+    log(f'AUC score on train: {auc_train:.2f}')
 
     # stats on test df
     p_test = model.predict_proba(X_test)[:,1]
     auc_test = sklearn.metrics.roc_auc_score(y_test, p_test)
-    print(f'AUC score on test: {auc_test:.2f}')
+    log(f'AUC score on test: {auc_test:.2f}')
     mse = sklearn.metrics.mean_squared_error(y_test, p_test)
-    print(f'MSE: {mse:.2f}')
+    log(f'MSE: {mse:.2f}')
     p_test_binary = model.predict(X_test)
     accuracy = sklearn.metrics.accuracy_score(y_test, p_test_binary)
-    print(f'accuracy: {accuracy:.2f}')
+    log(f'accuracy: {accuracy:.2f}')
 
     # features impotance
-    print('I am evaluating features importance')
-    imp = model.feature_importances_
-
-    perc_imp_list = []
-    list_imp_noPerc = []
+    log('I am evaluating features importance')
+    log('importances')
+    for column, importance in aggregate_importances(model.feature_importances_, columns).items():
+        log(f'{column} : {round(importance, 2)}')
 
-    # separate the perc featuers with the others
-    for i,j in zip(columns, imp):
-        if i.startswith('perc_'):
-            perc_imp_list.append(j)
-        else:
-            list_imp_noPerc.append(j)
 
-    # aggregate perc importances
-    perc_imp = sum(perc_imp_list)
-    # add the aggregated result
-    list_imp_noPerc.append(perc_imp)
+def aggregate_importances(importances, columns):
+    """Feature importances with the perc_* columns (vegetation densities) summed in a single "perc" entry.
 
-    # list of columns of interest
-    cols = [col for col in columns if not col.startswith('perc_')]
-    cols.append('perc')
+    :param importances: feature importances of a fitted model
+    :param columns: the columns of the dataset
+    :return: dictionary column -> importance, sorted by decreasing importance
+    """
+    dict_imp = {column: importance for column, importance in zip(columns, importances)
+                if not column.startswith('perc_')}
+    dict_imp['perc'] = sum(importance for column, importance in zip(columns, importances)
+                           if column.startswith('perc_'))
+    return dict(sorted(dict_imp.items(), key=lambda item: item[1], reverse=True))
+
+
+def spatial_folds(pixel_index, shape, n_folds=5, block_pixels=100, seed=None):
+    """Fold of every pixel for a spatial block cross-validation.
+
+    The raster is divided in square blocks of block_pixels x block_pixels pixels and every block is assigned
+    to a fold at random (the same number of blocks per fold), so that the test pixels of a fold are not
+    next to training pixels except at the borders of the blocks.
+
+    :param pixel_index: flat indices of the pixels in the full raster (e.g. from sample_pixels)
+    :param shape: shape of the full raster
+    :param n_folds: number of folds
+    :param block_pixels: side of the blocks in pixels
+    :param seed: seed of the random generator
+    :return: array with the fold (0 to n_folds - 1) of every pixel
+    """
+    rows, cols = np.divmod(np.asarray(pixel_index, dtype=np.int64), shape[1])
+    blocks = (rows // block_pixels) * -(-shape[1] // block_pixels) + cols // block_pixels
+    unique_blocks, block_of_pixel = np.unique(blocks, return_inverse=True)
+    if len(unique_blocks) < n_folds:
+        raise ValueError(f'{len(unique_blocks)} blocks are not enough for {n_folds} folds, reduce block_pixels')
+    fold_of_block = np.random.default_rng(seed).permutation(len(unique_blocks)) % n_folds
+    return fold_of_block[block_of_pixel]
+
+
+def _cross_validation_fold(data_dir, fold, params, seed):
+    """Fit a forest on all the folds but one and evaluate it on that one (see cross_validate_forest)"""
+    # the arrays are memory-mapped: all the processes share the same copy in the page cache
+    X = np.load(os.path.join(data_dir, "X.npy"), mmap_mode='r')
+    y = np.load(os.path.join(data_dir, "y.npy"), mmap_mode='r')
+    test = np.load(os.path.join(data_dir, "folds.npy"), mmap_mode='r') == fold
+    model = RandomForestClassifier(**params, random_state=seed, n_jobs=1)
+    model.fit(X[~test], y[~test])
+    p_train = model.predict_proba(X[~test])[:, 1]
+    p_test = model.predict_proba(X[test])[:, 1]
+    return {
+        "auc_train": sklearn.metrics.roc_auc_score(y[~test], p_train),
+        "auc_test": sklearn.metrics.roc_auc_score(y[test], p_test),
+        "mse": sklearn.metrics.mean_squared_error(y[test], p_test),
+        "accuracy": sklearn.metrics.accuracy_score(y[test], model.classes_[(p_test > 0.5).astype(int)]),
+        "importances": model.feature_importances_,
+    }
+
+
+@instrumented("cross_validation")
+def cross_validate_forest(X, y, pixel_index, shape, columns, param_grid, n_folds=5, block_pixels=100,
+        n_workers=None, seed=None, verbose=True):
+    """Spatial block cross-validation of random forests for a grid of parameters, in a pool of processes.
+
+    Every combination of parameters is fitted on every fold (see spatial_folds) in parallel. The features are
+    written once to memory-mapped files shared by the processes, instead of being pickled for every task.
+    The stats are those of fit_and_print_stats, averaged over the folds, with the feature importances
+    aggregated as in aggregate_importances.
+
+    :param X: 2D array with the features of the sample (e.g. gather_features of the pixels of sample_pixels)
+    :param y: the labels of the sample (1 burned, 0 not burned)
+    :param pixel_index: flat indices of the pixels of the sample in the full raster
+    :param shape: shape of the full raster
+    :param columns: the columns of X
+    :param param_grid: dictionary with lists of values of RandomForestClassifier parameters (or list of them,
+        see sklearn.model_selection.ParameterGrid), e.g. {"n_estimators": [50, 100], "max_depth": [8, 10]}
+    :param n_folds: number of folds
+    :param block_pixels: side of the spatial blocks in pixels
+    :param n_workers: Number of processes (number of CPUs by default)
+    :param seed: seed of the folds and of the forests
+    :param verbose: If True, show the progress
+    :return: pandas DataFrame with one row per combination of parameters, sorted by decreasing test AUC
 
-    # print results
-    print('importances')
-    dict_imp = dict(zip(cols, list_imp_noPerc))
-    dict_imp_sorted = {k: v for k, v in sorted(dict_imp.items(),
-                                                key=lambda item: item[1],
-                                                reverse=True)}
-    for i in dict_imp_sorted:
-        print(f'{i} : {round(dict_imp_sorted[i], 2)}')
+    usage example:
+    presence, absence = sample_pixels(feature_tiles, percentage=0.1, seed=42)
+    pixel_index = np.concatenate([presence, absence])
+    X_sample = gather_features(feature_tiles, pixel_index)
+    y_sample = np.concatenate([np.ones(len(presence)), np.zeros(len(absence))])
+    cv_table = cross_validate_forest(X_sample, y_sample, pixel_index, feature_tiles.shape, feature_tiles.columns,
+        {"n_estimators": [50, 100], "max_depth": [8, 10, 12]})
+    """
+    grid = list(ParameterGrid(param_grid))
+    results = {}
+    with tempfile.TemporaryDirectory() as data_dir:
+        np.save(os.path.join(data_dir, "X.npy"), np.asarray(X, dtype=np.float32))
+        np.save(os.path.join(data_dir, "y.npy"), np.asarray(y))
+        np.save(os.path.join(data_dir, "folds.npy"), spatial_folds(pixel_index, shape, n_folds, block_pixels, seed))
+        with ProcessPoolExecutor(max_workers=n_workers) as executor:
+            tasks = {executor.submit(_cross_validation_fold, data_dir, fold, params, seed): (number, fold)
+                     for number, params in enumerate(grid) for fold in range(n_folds)}
+            for task in tqdm(as_completed(tasks), total=len(tasks), desc="cross-validation", disable=not verbose):
+                results[tasks[task]] = task.result()
+
+    rows = []
+    for number, params in enumerate(grid):
+        folds = [results[number, fold] for fold in range(n_folds)]
+        row = dict(params)
+        for stat in ["auc_train", "auc_test", "mse", "accuracy"]:
+            row[stat] = np.mean([result[stat] for result in folds])
+        row["auc_test_std"] = np.std([result["auc_test"] for result in folds])
+        importances = np.mean([result["importances"] for result in folds], axis=0)
+        row.update({f"importance_{column}": importance
+                    for column, importance in aggregate_importances(importances, columns).items()})
+        rows.append(row)
+    return pd.DataFrame(rows).sort_values("auc_test", ascending=False, ignore_index=True)
 
 
 ### Functions to define hazard ###
 
+def build_lut(mapping, default=-1, size=None, dtype=int):
+    """Build a dense lookup table to reclassify a raster of non negative integer codes.
+
+    The table has a slot for every code from 0 to size-1, plus a last sentinel slot for the codes out of this
+    range (see apply_lut). The codes which are not in mapping, and the sentinel slot, get default.
+
+    :param mapping: dictionary {code: new value}
+    :param default: value of the codes not in mapping. If None, they keep their code (identity table, see apply_lut)
+    :param size: number of codes in the table (max code in mapping + 1 by default)
+    :param dtype: dtype of the table (and of the reclassified raster)
+    :return: 1D array of length size + 1
+
+    usage example:
+    lut = build_lut(converter_dict, default=-1)
+    """
+    codes = np.array([int(code) for code in mapping], dtype=np.int64)
+    if size is None:
+        size = int(codes.max()) + 1 if len(codes) > 0 else 0
+    if default is None:
+        lut = np.append(np.arange(size), 0).astype(dtype)
+    else:
+        lut = np.full(size + 1, default, dtype=dtype)
+    in_range = (codes >= 0) & (codes < size)
+    lut[codes[in_range]] = np.array(list(mapping.values()), dtype=dtype)[in_range]
+    return lut
+
+
+def apply_lut(array, lut, nodata=None, keep_out_of_range=False):
+    """Reclassify an array of integer codes with a table made by build_lut, in a single indexing pass.
+
+    The codes out of the table (negative or too large) take the value of the sentinel slot lut[-1].
+
+    :param array: array of integer codes
+    :param lut: lookup table made by build_lut
+    :param nodata: if not None, the pixels equal to nodata keep this value
+    :param keep_out_of_range: if True, the codes out of the table keep their code (for the identity tables)
+    :return: array with the new values, of the dtype of lut
+    """
+    sentinel = len(lut) - 1
+    codes = np.asarray(array).astype(np.int64)
+    out_of_range = (codes < 0) | (codes >= sentinel)
+    reclassified = lut[np.where(out_of_range, sentinel, codes)]
+    if keep_out_of_range:
+        reclassified[out_of_range] = codes[out_of_range].astype(lut.dtype)
+    if nodata is not None:
+        reclassified[array == nodata] = nodata
+    return reclassified
+
+
+@instrumented("classification")
+def reclassify_raster(input_file, output_file, lut, nodata=None, keep_out_of_range=False, block_size=512,
+                      n_workers=None, **kwargs):
+    """Reclassify a raster with a table made by build_lut, window by window.
+
+    :param input_file: Path to the raster with the integer codes
+    :param output_file: Path to the output raster
+    :param lut: lookup table made by build_lut
+    :param nodata: nodata value kept in the output (nodata of the input raster by default)
+    :param keep_out_of_range: if True, the codes out of the table keep their code (see apply_lut)
+    :param block_size: size of the windows in pixels
+    :param n_workers: Number of threads (number of CPUs by default)
+    :param kwargs: Keyword arguments to be passed to rasterio.open when creating the output raster
+    """
+    with rasterio.open(input_file) as src:
+        profile = src.profile
+    nodata = profile['nodata'] if nodata is None else nodata
+    profile.update(dtype=lut.dtype.name, nodata=nodata, count=1)
+    profile.update(**kwargs)
+
+    def reclassify(window):
+        return apply_lut(read_window(input_file, window), lut, nodata, keep_out_of_range)
+
+    with rasterio.open(output_file, 'w', **profile) as dst:
+        for window, data in map_windows(reclassify, raster_windows(input_file, block_size), n_workers):
+            dst.write(data, 1, window=window)
+
+
+@instrumented("classification")
 def corine_to_fuel_type(corine_codes_array, converter_dict, visualize_result = False):
     """Convert the corine land cover raster to a raster with the fuel types.
     
-    The fuel types are defined in the converter_dict dictionary.
+    The fuel types are defined in the converter_dict dictionary. Codes not in the dictionary (and nodata)
+    get -1. See reclassify_raster to convert a raster too large for the memory.
     """
-    # Use float type to allow for NaN fill for unsuccessful lookups
-    converted_band = np.vectorize(converter_dict.get, otypes=[np.float64])(corine_codes_array)
-    # Fill with int-compatible placeholder value and convert to int for output
-    converted_band = np.nan_to_num(converted_band, nan=-1)
-    converted_band = converted_band.astype(int)
+    converted_band = apply_lut(corine_codes_array, build_lut(converter_dict, default=-1))
     if visualize_result:
         plt.matshow(converted_band)
         # discrete colorbar
@@ -506,6 +1912,7 @@ def corine_to_fuel_type(corine_codes_array, converter_dict, visualize_result = F
     return converted_band
 
 
+@instrumented("classification")
 def susc_classes( susc_arr, quantiles):
     '''Take a raster map and a list of quantiles and returns a categorical raster map related to the quantile classes.
     
@@ -520,6 +1927,66 @@ def susc_classes( susc_arr, quantiles):
     return out_arr
 
 
+@instrumented("classification")
+def classify_matrix(xarr, yarr, xymatrix, nodatax, nodatay, x_bounds=None, block_rows=512, out=None):
+    """Classify pixels with a contingency matrix (e.g. hazard or risk matrix) in a single block-wise pass.
+
+    The class of a pixel is xymatrix[x - 1, y - 1], as in contigency_matrix_on_array: NaN values are taken as
+    class 1, the values are truncated to integers and the pixels where x == nodatax or y == nodatay get 0.
+    If x_bounds is given, xarr holds continuous values (e.g. susceptibility) and x is the class
+    susc_classes(xarr, x_bounds) + 1, computed in the same pass.
+    The rows are processed in blocks of block_rows, so the temporary arrays are only of the size of a block.
+
+    :param xarr: 2D array with the rows entry of the matrix, or a list (or 3D stack) of such arrays, all
+        classified against the same yarr in one sweep (e.g. the vulnerability layers against the hazard)
+    :param yarr: 2D array with the cols entry of the matrix
+    :param xymatrix: 2D array, contingency matrix
+    :param nodatax: value for no data in the classes of xarr
+    :param nodatay: value for no data in yarr
+    :param x_bounds: bounds of the classes of xarr (see susc_classes), None if xarr already holds the classes
+    :param block_rows: number of rows processed at once
+    :param out: int8 array where to write the result (e.g. a memory-mapped file), a new one by default
+    :return: int8 array with the classes, of the shape of yarr (a stack if xarr is a list or a 3D stack)
+
+    usage example:
+    hazard_arr = classify_matrix(Y_raster, converted_band, matrix_values, 0, -1, x_bounds=quantiles)
+    risk_arrs = classify_matrix([vul_arr_1, vul_arr_2], hazard_arr, risk_matrix, np.nan, 0)
+    """
+    single = not isinstance(xarr, (list, tuple)) and np.ndim(xarr) == 2
+    xarrs = [xarr] if single else list(xarr)
+    yarr = np.asarray(yarr)
+    xymatrix = np.asarray(xymatrix)
+    n_cols = xymatrix.shape[1]
+    flat_matrix = xymatrix.ravel().astype(np.int8)
+    if out is None:
+        out = np.empty((len(xarrs), *yarr.shape), dtype=np.int8)
+    out_stack = out[np.newaxis] if single and out.ndim == 2 else out
+
+    def to_classes(arr):
+        arr = np.asarray(arr)
+        if np.issubdtype(arr.dtype, np.floating):
+            arr = np.where(np.isnan(arr), 1, arr)
+        return arr.astype(np.int32)
+
+    for start in range(0, yarr.shape[0], block_rows):
+        rows = slice(start, start + block_rows)
+        y = to_classes(yarr[rows])
+        y_nodata = y == nodatay
+        for xarr_, out_ in zip(xarrs, out_stack):
+            if x_bounds is None:
+                x = to_classes(xarr_[rows])
+            else:
+                x = np.digitize(np.asarray(xarr_[rows]), list(x_bounds), right=True).astype(np.int32) + 1
+            nodata = y_nodata | (x == nodatax)
+            # row-major index in the matrix; no data pixels point to the first cell and are zeroed after
+            index = (x - 1) * n_cols + (y - 1)
+            index[nodata] = 0
+            block = out_[rows]
+            np.take(flat_matrix, index, out=block)
+            block[nodata] = 0
+    return out_stack[0] if single else out_stack
+
+
 def contigency_matrix_on_array(xarr, yarr, xymatrix, nodatax, nodatay):
     '''
     xarr: 2D array, rows entry of contingency matrix
@@ -527,22 +1994,7 @@ def contigency_matrix_on_array(xarr, yarr, xymatrix, nodatax, nodatay):
     xymatrix: 2D array, contingency matrix
     nodatax1: value for no data in xarr : if your array has nodata = np.nan >> nodatax or nodatay has to be 1
     nodatax2: value for no data in yarr : if your array has nodata = np.nan >> nodatax or nodatay has to be 1
+
+    The result is an int8 array, see classify_matrix.
     '''
-    # if arr have nan, mask it with lowest class
-    xarr = np.where(np.isnan(xarr)==True , 1, xarr)
-    yarr = np.where(np.isnan(yarr)==True , 1, yarr)
-    # convert to int
-    xarr = xarr.astype(int)
-    yarr = yarr.astype(int)
-
-    mask = np.where(((xarr == nodatax) | (yarr ==nodatay)), 0, 1)
-
-    # put lowest class in place of no data
-    yarr[~mask] = 1
-    xarr[~mask] = 1
-
-    # apply contingency matrix
-    output = xymatrix[ xarr - 1, yarr - 1]
-    # mask out no data
-    output[~mask] = 0
-    return output
+    return classify_matrix(xarr, yarr, xymatrix, nodatax, nodatay)
@@ -0,0 +1,106 @@
+"""Tests of shared_funcs, run with: python -m pytest 01_wildfire_ML"""
+import numpy as np
+import pytest
+import rasterio
+from rasterio.transform import from_origin
+from sklearn.ensemble import RandomForestClassifier
+
+import benchmark_shared_funcs
+import shared_funcs
+
+
+def write_dem(path, dem, nodata=None):
+    """Write a single band DEM with 30 m pixels."""
+    profile = {'driver': 'GTiff', 'height': dem.shape[0], 'width': dem.shape[1], 'count': 1,
+               'dtype': dem.dtype, 'crs': 'EPSG:3035', 'transform': from_origin(0, 0, 30, 30), 'nodata': nodata}
+    with rasterio.open(path, 'w', **profile) as dst:
+        dst.write(dem, 1)
+    return str(path)
+
+
+@pytest.fixture(scope="module")
+def synthetic_paths(tmp_path_factory):
+    """Small synthetic DEM, land cover, climate and fires rasters (see benchmark_shared_funcs)"""
+    return benchmark_shared_funcs.write_synthetic_rasters(tmp_path_factory.mktemp("data"), 96, n_types=5)
+
+
+def test_terrain_derivatives_integer_dem_without_nodata(tmp_path):
+    """An integer DEM with no nodata is padded with NaN like a float DEM."""
+    rows, cols = np.mgrid[0:70, 0:90]
+    dem = (3 * rows + 2 * cols + 10 * np.sin(cols / 7)).astype(np.int16)
+    int_path = write_dem(tmp_path / "dem_int16.tif", dem)
+    float_path = write_dem(tmp_path / "dem_float32.tif", dem.astype(np.float32))
+
+    result = shared_funcs.terrain_derivatives(int_path, block_size=32, n_workers=1)
+    expected = shared_funcs.terrain_derivatives(float_path, block_size=32, n_workers=1)
+    for label in shared_funcs.TERRAIN_LAYERS:
+        np.testing.assert_allclose(result[label], expected[label], rtol=1e-6, atol=1e-6)
+    # the border pixels have no complete neighbourhood
+    assert np.all(result['slope'][0] == -9999)
+    assert np.all(result['slope'][1:-1, 1:-1] >= 0)
+
+
+def test_apply_lut_identity_keeps_codes_out_of_range():
+    """With an identity table the codes out of the table keep their code, the nodata pixels keep nodata."""
+    lut = shared_funcs.build_lut({2: 0, 3: 0}, default=None, size=5)
+    codes = np.array([-3, 5, 7, 2, 4, -9999])
+    result = shared_funcs.apply_lut(codes, lut, nodata=-9999, keep_out_of_range=True)
+    np.testing.assert_array_equal(result, [-3, 5, 7, 0, 4, -9999])
+
+
+def test_apply_lut_default_for_unknown_codes():
+    """The codes not in the mapping, in or out of the table, get the default like dict.get."""
+    mapping = {1: 10, 3: 30}
+    codes = np.array([[1, 2, 3], [-1, 4, 99]])
+    expected = np.vectorize(lambda code: mapping.get(code, -1))(codes)
+    np.testing.assert_array_equal(shared_funcs.apply_lut(codes, shared_funcs.build_lut(mapping)), expected)
+
+
+def test_sample_pixels_in_store_order(synthetic_paths, tmp_path):
+    """The pixels drawn by strata are in the order of the rows of the feature store, as without strata."""
+    feature_tiles = shared_funcs.FeatureTiles({"dem": synthetic_paths["dem"]}, synthetic_paths["veg"],
+                                              synthetic_paths["climate"], synthetic_paths["fires"], block_size=32)
+    store = shared_funcs.build_feature_store(tmp_path / "store", feature_tiles, verbose=False)
+    row = {pixel: i for i, pixel in enumerate(np.asarray(store["pixel_index"]).tolist())}
+    fires = rasterio.open(synthetic_paths["fires"]).read(1).ravel()
+    for strata in (None, synthetic_paths["veg"]):
+        presence, absence = shared_funcs.sample_pixels(feature_tiles, 0.5, strata=strata, seed=3, n_workers=1,
+                                                       verbose=False)
+        assert len(presence) > 0 and len(absence) > 0
+        assert np.all(fires[presence] != 0) and np.all(fires[absence] == 0)
+        for pixels in (presence, absence):
+            assert np.all(np.diff([row[pixel] for pixel in pixels.tolist()]) > 0)
+
+
+def test_compiled_forest_predict_proba(tmp_path):
+    """A compiled forest, also saved and loaded back, gives the predict_proba of the random forest."""
+    X_train, Y_train = benchmark_shared_funcs.synthetic_sample(2000, seed=1)
+    model = RandomForestClassifier(n_estimators=10, max_depth=6, random_state=0).fit(X_train, Y_train)
+    forest = shared_funcs.compile_forest(model)
+    forest.save(tmp_path / "model.npz")
+
+    X, _ = benchmark_shared_funcs.synthetic_sample(5000, seed=2)
+    expected = model.predict_proba(X)
+    np.testing.assert_array_equal(forest.predict_proba(X, block_size=1024), expected)
+    np.testing.assert_array_equal(shared_funcs.CompiledForest.load(tmp_path / "model.npz").predict_proba(X), expected)
+
+
+def test_susceptibility_round_trip(synthetic_paths, tmp_path):
+    """A float32 susceptibility written as a continuous product is read back exactly, NaN included."""
+    rng = np.random.default_rng(0)
+    susceptibility = rng.random((96, 96)).astype(np.float32)
+    susceptibility[rng.random(susceptibility.shape) < 0.1] = np.nan
+    path = tmp_path / "susceptibility.tif"
+    shared_funcs.write_raster(susceptibility, path, synthetic_paths["dem"], product="continuous", block_size=32)
+    np.testing.assert_array_equal(shared_funcs.read_raster(path), susceptibility)
+
+
+@pytest.mark.parametrize("window_size", [1, 2, 3])
+def test_vegetation_density_matches_convolution(window_size):
+    """The densities are the convolution of every type cast to float32, the integer dtype gives the counts."""
+    veg_int, types = benchmark_shared_funcs.synthetic_vegetation(80, 5)
+    expected = benchmark_shared_funcs.legacy_vegetation_density(veg_int, types, window_size)
+    np.testing.assert_array_equal(shared_funcs.vegetation_density(veg_int, types, window_size, n_workers=2),
+                                  expected.astype(np.float32))
+    counts = shared_funcs.vegetation_density(veg_int, types, window_size, dtype=np.uint8)
+    np.testing.assert_allclose(100 * counts.astype(np.float64) / (2*window_size + 1)**2, expected, atol=1e-12)